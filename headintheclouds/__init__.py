@@ -1,37 +1,91 @@
+import os
 import sys
 import re
+import time
+import threading
 import collections
 
 from fabric.api import * # pylint: disable=W0614,W0401
 import fabric.api as fab
 
+def _discovering(method):
+    def wrapper(self, *args, **kwargs):
+        discover_nodes()
+        return method(self, *args, **kwargs)
+    return wrapper
+
+class _LazyRoledefs(dict):
+    '''
+    env.roledefs, filled in from the providers' nodes the first time
+    it's read, so that importing a fabfile doesn't call any cloud APIs.
+    '''
+    for _name in ['__getitem__', '__contains__', '__iter__', '__len__', '__repr__',
+                  'get', 'has_key', 'keys', 'values', 'items',
+                  'iterkeys', 'itervalues', 'iteritems']:
+        locals()[_name] = _discovering(getattr(dict, _name))
+    del _name
+
+class _LazyHosts(list):
+    '''
+    env.hosts, filled in with every node the first time it's read.
+    '''
+    for _name in ['__getitem__', '__contains__', '__iter__', '__len__', '__repr__',
+                  'index', 'count']:
+        locals()[_name] = _discovering(getattr(list, _name))
+    del _name
+
 env.disable_known_hosts = True
 env.node_providers = {}
 env.providers = {}
-env.roledefs = collections.defaultdict(list)
+env.roledefs = _LazyRoledefs()
 env.name_prefix = getattr(env, 'name_prefix', 'HITC-')
 
 # hack tocheck if the user has provided -H option
 _has_hosts_option = bool(env.hosts)
 
+# unless the user has provided -H or -R, tasks run on all nodes. with
+# -R, fabric looks up the hosts in env.roledefs
+if not _has_hosts_option and not env.roles:
+    env.hosts = _LazyHosts()
+
+# providers whose nodes have been added to env.roledefs and env.hosts
+_discovered_providers = set()
+
+# seconds to wait for a provider to list its nodes
+DISCOVERY_TIMEOUT = float(os.environ.get('HITC_DISCOVERY_TIMEOUT', 60))
+
 def add_provider(name, module):
-    for node in module.all_nodes():
-        if not node.get('ip', None):
-            continue
+    env.providers[name] = module
 
-        ip = node['ip']
-        role = re.sub('-[0-9]+$', '', node['name'])
-        env.roledefs[role].append(ip)
+    # providers imported after the nodes have been discovered are
+    # discovered straight away
+    if _discovered_providers:
+        discover_nodes()
 
-        if env.roles:
-            if role in env.roles:
-                env.hosts.append(ip)
-        elif not _has_hosts_option:
-            env.hosts.append(ip)
+def discover_nodes():
+    '''
+    Add the nodes of all providers to env.roledefs, env.hosts and
+    env.node_providers. This happens the first time any of those are
+    needed, not when the provider is imported.
+    '''
+    providers = {name: module for name, module in env.providers.items()
+                 if name not in _discovered_providers}
+    _discovered_providers.update(providers)
 
-        env.node_providers[ip] = module
+    nodes_by_provider = provider_nodes(providers, ignore_errors=True)
+    for name, module in providers.items():
+        for node in nodes_by_provider.get(name, []):
+            if not node.get('ip', None):
+                continue
 
-    env.providers[name] = module
+            ip = node['ip']
+            role = re.sub('-[0-9]+$', '', node['name'])
+            dict.setdefault(env.roledefs, role, []).append(ip)
+
+            if isinstance(env.hosts, _LazyHosts):
+                env.hosts.append(ip)
+
+            env.node_providers[ip] = module
 
 def provider_by_name(provider_name):
     if provider_name is None:
@@ -49,18 +103,127 @@ def provider_settings():
     settings = this_provider().settings
     return fab.settings(**settings)
 
-def this_provider():
+def this_provider(host=None):
     if hasattr(env, 'provider'):
         return provider_by_name(env.provider)
     else:
-        if env.host in env.node_providers:
-            return env.node_providers[env.host]
+        if host is None:
+            host = env.host
+        discover_nodes()
+        if host in env.node_providers:
+            return env.node_providers[host]
+
+        # nodes created since discovery
+        for provider in env.providers.values():
+            if host in node_index(provider.all_nodes).by_ip:
+                return provider
     raise Exception('Unknown host')
 
-def all_nodes():
+def hosts_by_provider(hosts):
+    '''
+    Group hosts by the provider they belong to. Returns a dict of
+    provider module to the hosts' nodes, in the order of hosts.
+    '''
+    nodes = collections.OrderedDict()
+    for host in hosts:
+        provider = this_provider(host)
+        nodes.setdefault(provider, []).append(host_node(provider.all_nodes, host))
+    return nodes
+
+NodeIndex = collections.namedtuple('NodeIndex', ['nodes', 'by_ip', 'by_id'])
+
+# all_nodes function -> NodeIndex of the list it last returned
+_node_indexes = {}
+
+def node_index(all_nodes):
+    '''
+    Return a NodeIndex with ip -> node and id -> node dicts of the
+    nodes returned by a provider's all_nodes function. The index is
+    only rebuilt when all_nodes returns a different list than last
+    time, which for cached node lists is when the cache is refreshed.
+    '''
+    nodes = all_nodes()
+    index = _node_indexes.get(all_nodes)
+    if index is None or index.nodes is not nodes:
+        index = NodeIndex(nodes,
+                          {n['ip']: n for n in nodes if n.get('ip')},
+                          {n['id']: n for n in nodes if 'id' in n})
+        _node_indexes[all_nodes] = index
+    return index
+
+def host_node(all_nodes, host=None):
+    '''
+    Return the node of host (env.host by default) from a provider's
+    all_nodes function.
+    '''
+    if host is None:
+        host = env.host
+    try:
+        return node_index(all_nodes).by_ip[host]
+    except KeyError:
+        raise Exception('Unknown host: %s' % host)
+
+def all_nodes(refresh=False, ignore_errors=False):
     nodes = []
-    for name, provider in env.providers.items():
-        for node in provider.all_nodes():
-            node['provider'] = name
-            nodes.append(node)
+    nodes_by_provider = provider_nodes(env.providers, refresh, ignore_errors)
+    for name in env.providers:
+        for node in nodes_by_provider.get(name, []):
+            # the provider's nodes may be shared cache values
+            nodes.append(dict(node, provider=name))
     return nodes
+
+def provider_nodes(providers, refresh=False, ignore_errors=False,
+                   timeout=None):
+    '''
+    Call all_nodes() on all the providers at the same time and return
+    a dict of provider name to nodes, so that listing the nodes takes
+    as long as the slowest provider rather than all of them together.
+
+    A provider that raises or doesn't answer within DISCOVERY_TIMEOUT
+    seconds is left out with a warning if ignore_errors is set,
+    otherwise the error is raised once all providers are done.
+    '''
+    from headintheclouds import cache
+
+    if timeout is None:
+        timeout = DISCOVERY_TIMEOUT
+
+    results = {}
+    errors = {}
+
+    def fetch(name, module):
+        try:
+            if refresh and hasattr(module.all_nodes, '_cached'):
+                results[name] = cache.recache(module.all_nodes)
+            else:
+                results[name] = module.all_nodes()
+        except BaseException:
+            # including SystemExit from fabric's abort()
+            errors[name] = sys.exc_info()
+
+    threads = {}
+    for name, module in providers.items():
+        thread = threading.Thread(target=fetch, args=(name, module))
+        # don't wait for a hanging provider on exit
+        thread.daemon = True
+        thread.start()
+        threads[name] = thread
+
+    deadline = time.time() + timeout
+    nodes_by_provider = {}
+    for name, thread in sorted(threads.items()):
+        thread.join(max(deadline - time.time(), 0))
+        if thread.is_alive():
+            error = (Exception, Exception(
+                'Timed out after %s seconds listing %s nodes' % (timeout, name)), None)
+        elif name in errors:
+            error = errors[name]
+        else:
+            nodes_by_provider[name] = results[name]
+            continue
+
+        if not ignore_errors:
+            raise error[0], error[1], error[2]
+        warn('Failed to list %s nodes: %s' % (name, error[1]))
+
+    return nodes_by_provider
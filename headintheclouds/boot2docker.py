@@ -1,13 +1,21 @@
 import os
 import sys
+import collections
+from functools import wraps
 from fabric.api import * # pylint: disable=W0614,W0401
 import fabric.api as fab
 
 import headintheclouds
-from headintheclouds import util
+from headintheclouds import util, cache
 
 __all__ = []
 
+# set HITC_BOOT2DOCKER_CACHE=true to keep the VM's IP, SSH key and port
+# in the hitc cache between runs, rather than asking boot2docker once
+# per run. `fab uncache` clears them
+PERSIST_VM_CONFIG = os.environ.get('HITC_BOOT2DOCKER_CACHE', None) == 'true'
+PERSIST_TTL = 24 * 60 * 60
+
 def terminate():
     raise NotImplementedError()
 
@@ -34,16 +42,33 @@ create_server_defaults = {
     'ip': None
 }
 
+def _vm_config(func):
+    '''
+    Look the value up at most once per run, and only when it's first
+    needed.
+    '''
+    persisted = cache.cached(func, ttl=PERSIST_TTL)
+
+    @wraps(func)
+    def wrapper():
+        if not hasattr(wrapper, 'value'):
+            wrapper.value = persisted() if PERSIST_VM_CONFIG else func()
+        return wrapper.value
+    return wrapper
+
+@_vm_config
 def get_boot2docker_ip():
     with hide('everything'):
         return local('boot2docker ip', capture=True)
 
+@_vm_config
 def get_boot2docker_ssh_port():
     return 22
     # TODO:
     # with hide('everything'):
     #    return local("boot2docker config | awk '/SSHPort/ { print $3 }'", capture=True)
 
+@_vm_config
 def get_boot2docker_ssh_key():
     with hide('everything'):
         key = local("boot2docker config | awk '/SSHKey/ { print $3 }'", capture=True)
@@ -61,11 +86,31 @@ def all_nodes():
     }]
     return nodes
 
-settings = {
-    'user': 'docker',
-    'key_filename': get_boot2docker_ssh_key(),
-    'port': get_boot2docker_ssh_port(),
-    'shell': '/bin/sh -c',
-}
+class _Settings(collections.Mapping):
+    '''
+    Provider settings where functions are called for their value when
+    the setting is read, so that importing the module doesn't run
+    boot2docker.
+    '''
+
+    def __init__(self, **values):
+        self.values = values
+
+    def __getitem__(self, key):
+        value = self.values[key]
+        return value() if callable(value) else value
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+settings = _Settings(
+    user='docker',
+    key_filename=get_boot2docker_ssh_key,
+    port=get_boot2docker_ssh_port,
+    shell='/bin/sh -c',
+)
 
 headintheclouds.add_provider('boot2docker', sys.modules[__name__])
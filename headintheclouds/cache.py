@@ -1,34 +1,141 @@
 import os
+import sys
 import errno
-from headintheclouds.dependencies import PyDbLite
+from headintheclouds.dependencies.PyDbLite import SQLite
 import cPickle
 import time
+import collections
+import threading
+import atexit
+import hashlib
+import simplejson as json
 from functools import wraps
 
-FILENAME = '~/.hitc/cache.pdl'
+FILENAME = '~/.hitc/cache.sqlite'
 
 NO_CACHE = os.environ.get('HITC_NO_CACHE', None) == 'true'
 
+# least recently used entries are evicted when the cache grows beyond
+# either of these
+MAX_ENTRIES = int(os.environ.get('HITC_CACHE_MAX_ENTRIES', 10000))
+MAX_BYTES = int(os.environ.get('HITC_CACHE_MAX_BYTES', 100 * 1024 * 1024))
+
+# number of writes between checking the size limits. they're also checked
+# every time the cache is opened
+EVICT_INTERVAL = 100
+
+# number of deserialised values to keep in memory
+MEMORY_SIZE = 128
+
+# default seconds that @cached functions remember a None result, and an
+# exception
+NONE_TTL = 60
+ERROR_TTL = 10
+
+# seconds to wait for another process' write lock before giving up
+LOCK_TIMEOUT = 30
+
 _cursor = None
+_cursor_pid = None
+
+# connections inherited over fork(). they must not be used in the child,
+# but neither should they be garbage collected there, since closing them
+# can interfere with the parent's locks on the database
+_inherited_cursors = []
+
+# in-process LRU of key -> (value, expire), in front of the database.
+# values are shared between callers rather than unpickled on every get,
+# so callers must copy them before making changes
+_memory = collections.OrderedDict()
+
+# hit/miss counters not yet added to the stats table
+_stats = collections.Counter()
+
+_writes = 0
+
+# key -> last access time, not yet written to the database. reads don't
+# write, the access times are saved when entries are evicted or at exit
+_accesses = {}
+
+# @cached functions may be refreshed in background threads, which share
+# the connection and the LRU with the main thread
+_lock = threading.RLock()
+_lock_pid = os.getpid()
+
+# cache keys with a background refresh in flight
+_refreshing = {}
 
 python_set = set
 
+_unpicklable = object()
+
+# what @cached stores, so that a cached None can be told apart from a
+# cache miss. error is the exception that func raised, if any
+CacheEntry = collections.namedtuple('CacheEntry', ['refresh_at', 'value', 'error'])
+
+def _locked(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        _reset_after_fork()
+        with _lock:
+            return func(*args, **kwargs)
+    return wrapper
+
+def _reset_after_fork():
+    global _lock, _lock_pid
+
+    if _lock_pid != os.getpid():
+        # a forked ensemble worker may have been forked while another
+        # thread held the lock, and the refresh threads weren't copied
+        _lock = threading.RLock()
+        _lock_pid = os.getpid()
+        _refreshing.clear()
+        _memory.clear()
+
+@_locked
 def get(key):
     if NO_CACHE:
         return None
 
-    records = _db()._key[key]
+    if key in _memory:
+        value, expire = _memory.pop(key)
+        if not expire or expire > time.time():
+            _memory[key] = (value, expire)
+            _stats['memory_hits'] += 1
+            _accesses[key] = time.time()
+            return value
+
+    records = _db()(key=key)
 
     if records:
         record = records[0]
-        value = record['value']
         expire = record['expire']
         if not expire or expire > time.time():
-            return cPickle.loads(str(value))
-        delete(key)
+            try:
+                value = cPickle.loads(str(record['value']))
+            except Exception:
+                # e.g. an exception whose __init__ doesn't take its
+                # args, which pickles but can't be unpickled
+                value = _unpicklable
+            if value is not _unpicklable:
+                _remember(key, value, expire)
+                _stats['disk_hits'] += 1
+                _accesses[key] = time.time()
+                return value
+
+        # expired or unreadable. another process may have replaced the
+        # value since we read it
+        _db().cursor.execute('DELETE FROM cache WHERE key = ? AND expire = ?',
+                             (key, expire))
+        _db().commit()
+
+    _stats['misses'] += 1
     return None
 
+@_locked
 def set(key, value, ttl=None):
+    global _writes
+
     if NO_CACHE:
         return None
 
@@ -37,38 +144,168 @@ def set(key, value, ttl=None):
     else:
         expire = time.time() + ttl
 
-    records = _db()._key[key]
-    _db().delete(records)
-    _db().insert(key=key, value=cPickle.dumps(value), expire=expire)
+    # a single statement, so concurrent writers can't interleave a
+    # delete and an insert for the same key
+    pickled = cPickle.dumps(value)
+    _db().cursor.execute(
+        'INSERT OR REPLACE INTO cache (key, expire, size, accessed, value) '
+        'VALUES (?, ?, ?, ?, ?)',
+        (key, expire, len(pickled), time.time(), SQLite.sqlite.Binary(pickled)))
     _db().commit()
+    _remember(key, value, expire)
 
+    _writes += 1
+    if _writes % EVICT_INTERVAL == 0:
+        _evict()
+        _db().commit()
+
+@_locked
 def delete(key):
     if NO_CACHE:
         return None
 
-    records = _db()._key[key]
+    _memory.pop(key, None)
+
+    records = _db()(key=key)
     if not records:
         return None
     _db().delete(records)
     _db().commit()
 
+@_locked
 def flush():
     global _cursor
 
-    try:
-        os.unlink(_filename())
-    except OSError, e:
-        if e.errno != errno.ENOENT:
-            raise
+    if _cursor is not None and _cursor_pid == os.getpid():
+        _cursor.conn.close()
     _cursor = None
+    _memory.clear()
+    _accesses.clear()
+    _stats.clear()
+
+    # in WAL mode sqlite keeps the write-ahead log and shared memory
+    # index next to the main database file
+    for suffix in ('', '-wal', '-shm'):
+        try:
+            os.unlink(_filename() + suffix)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+@_locked
+def compact():
+    '''
+    Drop expired entries, evict least recently used entries beyond
+    MAX_ENTRIES and MAX_BYTES, and give the free space back to the
+    filesystem if enough of the file is unused. Runs every time the
+    cache is opened.
+    '''
+    if NO_CACHE:
+        return None
+
+    _db()
+    _sweep()
 
+@_locked
 def size():
     if NO_CACHE:
         return None
 
-    return len(_db().records)
+    return len(_db())
+
+@_locked
+def stats():
+    '''
+    Entry count, size in bytes of the stored values and of the file on
+    disk, and memory_hits, disk_hits and misses counted over all
+    processes since the cache was created.
+    '''
+    if NO_CACHE:
+        return None
+
+    counters = collections.Counter(dict(
+        _db().cursor.execute('SELECT name, value FROM stats').fetchall()))
+    counters.update(_stats)
+
+    ret = dict(counters)
+    ret['entries'], ret['bytes'] = _db().cursor.execute(
+        'SELECT COUNT(*), TOTAL(size) FROM cache').fetchone()
+    ret['bytes'] = int(ret['bytes'])
+    ret['file_bytes'] = sum(os.path.getsize(_filename() + suffix)
+                            for suffix in ('', '-wal')
+                            if os.path.exists(_filename() + suffix))
+    return ret
+
+@_locked
+def biggest(n=10):
+    '''
+    The n largest entries, as dicts with key, size and expire.
+    '''
+    if NO_CACHE:
+        return []
+
+    rows = _db().cursor.execute(
+        'SELECT key, size, expire FROM cache ORDER BY size DESC LIMIT ?', (n,))
+    return [{'key': key, 'size': size, 'expire': expire}
+            for key, size, expire in rows.fetchall()]
+
+def cached(func=None, ttl=None, stale_ttl=0, none_ttl=NONE_TTL,
+           error_ttl=ERROR_TTL, namespace=None):
+    '''
+    Cache the return value of func, keyed on its arguments. Can be used
+    as @cached or @cached(ttl=..., stale_ttl=...).
+
+    After ttl seconds the value goes stale. For another stale_ttl
+    seconds (forever if stale_ttl is None) the stale value is still
+    returned immediately, while func is called in a background thread
+    to refresh it. After that the value has expired and func is called
+    synchronously. Without a ttl values never go stale.
+
+    None results are cached for none_ttl seconds. If func raises, the
+    exception is cached for error_ttl seconds and raised again on every
+    call until then. Set either to 0 to not cache those.
+
+    namespace is a function returning whatever else the result depends
+    on, e.g. the provider account and env.name_prefix. It's called on
+    every lookup and becomes part of the cache key.
+    '''
+    if func is None:
+        return lambda func: cached(func, ttl=ttl, stale_ttl=stale_ttl,
+                                   none_ttl=none_ttl, error_ttl=error_ttl,
+                                   namespace=namespace)
+
+    if ttl is None or stale_ttl is None:
+        cache_ttl = None
+    else:
+        cache_ttl = ttl + stale_ttl
+
+    def call_and_set(cache_key, args, kwargs, cache_errors=True):
+        try:
+            ret = func(*args, **kwargs)
+        except Exception, e:
+            exc_info = sys.exc_info()
+            if cache_errors and error_ttl:
+                try:
+                    # only cache errors that other processes can read
+                    cPickle.loads(cPickle.dumps(e))
+                except Exception:
+                    pass
+                else:
+                    set(cache_key, CacheEntry(0, None, e), error_ttl)
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        if ret is None:
+            if none_ttl:
+                set(cache_key, CacheEntry(0, None, None), none_ttl)
+            return ret
+
+        if ttl is None:
+            refresh_at = 0
+        else:
+            refresh_at = time.time() + ttl
+        set(cache_key, CacheEntry(refresh_at, ret, None), cache_ttl)
+        return ret
 
-def cached(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
         recache = kwargs.get('_recache')
@@ -78,26 +315,46 @@ def cached(func):
         if uncache:
             del kwargs['_uncache']
 
-        cache_key = func.__module__ + '.' + func.__name__
-        if args or kwargs:
-            cache_key += cPickle.dumps((args, kwargs))
+        if namespace is None:
+            cache_key = make_key(func, args, kwargs)
+        else:
+            cache_key = make_key(func, args, kwargs, namespace())
 
         if uncache:
             delete(cache_key)
             return None
 
         if recache:
-            ret = func(*args, **kwargs)
-            set(cache_key, ret)
-        else:
-            ret = get(cache_key)
-            if ret is None:
-                ret = func(*args, **kwargs)
-                set(cache_key, ret)
-        return ret
+            return call_and_set(cache_key, args, kwargs)
+
+        entry = get(cache_key)
+        if entry is None:
+            return call_and_set(cache_key, args, kwargs)
+
+        if entry.error is not None:
+            raise entry.error
+
+        if entry.refresh_at and entry.refresh_at < time.time():
+            _refresh_in_background(cache_key, call_and_set, args, kwargs)
+        return entry.value
     wrapper._cached = True
     return wrapper
 
+def make_key(func, args=(), kwargs=None, namespace=None):
+    '''
+    A cache key for calling func with args and kwargs. The function name
+    is kept readable; the arguments and namespace are hashed from a
+    canonical JSON form, so the key is the same across processes and
+    regardless of keyword argument order.
+    '''
+    name = func.__module__ + '.' + func.__name__
+    if not args and not kwargs and namespace is None:
+        return name
+
+    canonical = json.dumps([namespace, list(args), kwargs or {}],
+                           sort_keys=True, separators=(',', ':'), default=repr)
+    return name + ':' + hashlib.sha1(canonical).hexdigest()
+
 def recache(fn, *args, **kwargs):
     if NO_CACHE:
         return fn(*args, **kwargs)
@@ -120,24 +377,126 @@ def uncache(fn, *args, **kwargs):
     kwargs['_uncache'] = True
     fn(*args, **kwargs)
 
+def _refresh_in_background(cache_key, call_and_set, args, kwargs):
+    _reset_after_fork()
+    with _lock:
+        if cache_key in _refreshing:
+            return
+
+        def refresh():
+            try:
+                call_and_set(cache_key, args, kwargs, cache_errors=False)
+            except Exception:
+                # keep serving the stale value, the next call retries
+                pass
+            finally:
+                with _lock:
+                    del _refreshing[cache_key]
+
+        # not a daemon thread, so a short-lived fab run still finishes
+        # the refresh before exiting
+        thread = threading.Thread(target=refresh)
+        _refreshing[cache_key] = thread
+        thread.start()
+
 def _db():
-    global _cursor
+    global _cursor, _cursor_pid
+
+    if _cursor is not None and _cursor_pid != os.getpid():
+        # we're in a forked ensemble worker, get our own connection
+        _inherited_cursors.append(_cursor)
+        _cursor = None
+
     if _cursor is None:
         try:
             os.makedirs(os.path.dirname(_filename()))
         except OSError, e:
             if e.errno != errno.EEXIST:
                 raise
-        _cursor = PyDbLite.Base(_filename())
-        try:
-            _cursor.open()
-        except IOError, e:
-            if e.errno != errno.ENOENT:
-                raise
-            _cursor.create('key', 'value', 'expire')
-            _cursor.create_index('key')
-            
+
+        # each set/delete only touches the rows for its own key, instead
+        # of re-pickling the whole cache on every commit. WAL mode
+        # makes those commits appends to the log. sqlite's file locking
+        # serialises writers from forked processes
+        conn = SQLite.sqlite.connect(_filename(), timeout=LOCK_TIMEOUT,
+                                     check_same_thread=False)
+        conn.text_factory = str
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        # value goes last, so reading the other columns doesn't have to
+        # follow the overflow pages of big values
+        conn.execute('CREATE TABLE IF NOT EXISTS cache '
+                     '(key TEXT PRIMARY KEY, expire REAL, size INTEGER, '
+                     'accessed REAL, value BLOB)')
+        conn.execute('CREATE TABLE IF NOT EXISTS stats '
+                     '(name TEXT PRIMARY KEY, value INTEGER)')
+
+        _cursor = SQLite.Table('cache', conn).open()
+        _cursor_pid = os.getpid()
+
+        _sweep()
+
     return _cursor
 
+def _sweep():
+    _cursor.cursor.execute('DELETE FROM cache WHERE expire > 0 AND expire <= ?',
+                           (time.time(),))
+    _evict()
+    _cursor.commit()
+
+    page_count = _cursor.cursor.execute('PRAGMA page_count').fetchone()[0]
+    freelist_count = _cursor.cursor.execute('PRAGMA freelist_count').fetchone()[0]
+    if freelist_count > page_count / 4:
+        _cursor.cursor.execute('VACUUM')
+
+def _evict():
+    _save_accesses()
+
+    entries, nbytes = _cursor.cursor.execute(
+        'SELECT COUNT(*), TOTAL(size) FROM cache').fetchone()
+    excess_entries = entries - MAX_ENTRIES
+    excess_bytes = nbytes - MAX_BYTES
+    if excess_entries <= 0 and excess_bytes <= 0:
+        return
+
+    evicted = []
+    rows = _cursor.cursor.execute('SELECT key, size FROM cache ORDER BY accessed')
+    for key, size in rows.fetchall():
+        if excess_entries <= 0 and excess_bytes <= 0:
+            break
+        evicted.append(key)
+        excess_entries -= 1
+        excess_bytes -= size
+
+    _cursor.cursor.executemany('DELETE FROM cache WHERE key = ?',
+                               [(key,) for key in evicted])
+    for key in evicted:
+        _memory.pop(key, None)
+
+def _save_accesses():
+    _cursor.cursor.executemany('UPDATE cache SET accessed = ? WHERE key = ?',
+                               [(t, key) for key, t in _accesses.items()])
+    _accesses.clear()
+
+@atexit.register
+@_locked
+def _save_stats():
+    if _cursor is None or _cursor_pid != os.getpid():
+        return
+
+    _save_accesses()
+    for name, value in _stats.items():
+        _cursor.cursor.execute('INSERT OR IGNORE INTO stats VALUES (?, 0)', (name,))
+        _cursor.cursor.execute('UPDATE stats SET value = value + ? WHERE name = ?',
+                               (value, name))
+    _cursor.commit()
+    _stats.clear()
+
+def _remember(key, value, expire):
+    _memory.pop(key, None)
+    _memory[key] = (value, expire)
+    while len(_memory) > MEMORY_SIZE:
+        _memory.popitem(last=False)
+
 def _filename():
     return os.path.abspath(os.path.expanduser(FILENAME))
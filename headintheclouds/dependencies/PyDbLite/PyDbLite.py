@@ -55,13 +55,31 @@ version 2.4 :
 
 version 2.5 :
 - test is now in folder test
+
+version 2.6 :
+- add lazy mode : Base(name,lazy=True) stores each record as a separate
+  pickle ; open() only loads the field names and indices, records are
+  unpickled from a memory-mapped file when they are first accessed
+
+version 2.7 :
+- add journal mode : Base(name,journal=True) appends the records changed
+  since the last commit to a journal file, which is replayed by open()
+  and merged into the base when it grows beyond journal_size
+- full writes go to a temporary file that replaces the base atomically
+
+version 2.8 :
+- add hash indices : create_index(field,kind='hash') maps each value to
+  a set of ids instead of a sorted list, for O(1) insert and delete
 """
 
-version = "2.5"
+version = "2.8"
 
 import os
+import errno
 import cPickle
 import bisect
+import mmap
+import struct
 
 # compatibility with Python 2.3
 try:
@@ -69,6 +87,14 @@ try:
 except NameError:
     from sets import Set as set
     
+class HashIndex(dict):
+    """Storage of a hash index : maps field values to the set of ids of
+    the records with that value. Adding and removing an id is O(1), but
+    the ids are not kept sorted"""
+    pass
+
+INDEX_KINDS = {'bisect':dict,'hash':HashIndex}
+
 class Index:
     """Class used for indexing a base on a field
     The instance of Index is an attribute the Base instance"""
@@ -89,6 +115,85 @@ class Index:
         ids = self.db.indices[self.field].get(key,[])
         return [ self.db.records[_id] for _id in ids ]
 
+# lazy mode file layout : LAZY_MAGIC, the offset of the metadata as an
+# unsigned 64-bit integer, the pickled records one after the other, then
+# the metadata : a pickled tuple (fields,next_id,indices,offsets) where
+# offsets maps record ids to the (offset,length) of their pickle
+LAZY_MAGIC = 'PyDbLite-lazy-1\n'
+LAZY_HEADER = struct.Struct('>Q')
+
+# journal mode : each commit appends one pickled list of operations
+# ('put',record), ('delete',_id) and ('next_id',next_id) to the journal.
+# Replaying an operation twice has the same effect as replaying it once
+JOURNAL_SIZE = 1024*1024
+
+class LazyRecords:
+    """Mapping between record ids and records, used as Base.records in
+    lazy mode. A record is unpickled from the memory-mapped file the
+    first time it is accessed, then kept in memory"""
+
+    def __init__(self,data,offsets,loaded=None):
+        self.data = data # mmap of the base file
+        self.offsets = offsets # id -> (offset,length) of unloaded records
+        self.loaded = loaded or {} # id -> record
+
+    def raw(self,_id):
+        """Pickled record, if it hasn't been loaded yet"""
+        offset,length = self.offsets[_id]
+        return self.data[offset:offset+length]
+
+    def __getitem__(self,_id):
+        try:
+            return self.loaded[_id]
+        except KeyError:
+            record = cPickle.loads(self.raw(_id))
+            del self.offsets[_id]
+            self.loaded[_id] = record
+            return record
+
+    def get(self,_id,default=None):
+        if _id in self:
+            return self[_id]
+        return default
+
+    def __setitem__(self,_id,record):
+        self.offsets.pop(_id,None)
+        self.loaded[_id] = record
+
+    def __delitem__(self,_id):
+        if _id in self.loaded:
+            del self.loaded[_id]
+        else:
+            del self.offsets[_id]
+
+    def __contains__(self,_id):
+        return _id in self.loaded or _id in self.offsets
+
+    def __len__(self):
+        return len(self.loaded) + len(self.offsets)
+
+    def keys(self):
+        return self.loaded.keys() + self.offsets.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    iterkeys = __iter__
+
+    def values(self):
+        return [ self[_id] for _id in self.keys() ]
+
+    def itervalues(self):
+        for _id in self.keys():
+            yield self[_id]
+
+    def items(self):
+        return [ (_id,self[_id]) for _id in self.keys() ]
+
+    def iteritems(self):
+        for _id in self.keys():
+            yield _id,self[_id]
+
 class Tester:
 
     def __init__(self,db,key):
@@ -150,12 +255,25 @@ class Tester:
 
 class Base:
 
-    def __init__(self,basename,protocol=cPickle.HIGHEST_PROTOCOL):
+    def __init__(self,basename,protocol=cPickle.HIGHEST_PROTOCOL,lazy=False,
+        journal=False,journal_size=JOURNAL_SIZE):
         """protocol as defined in pickle / cPickle
         Defaults to the highest protocol available
-        For maximum compatibility use protocol = 0"""
+        For maximum compatibility use protocol = 0
+        If lazy is set, the base is saved in the lazy mode layout and
+        records are only unpickled when they are accessed
+        If journal is set, commit() appends the changes to a journal
+        and only writes the whole base when the journal is larger than
+        journal_size bytes"""
         self.name = basename
         self.protocol = protocol
+        self.lazy = lazy
+        self.journal = journal
+        self.journal_size = journal_size
+        self.journal_name = basename + '.journal'
+        # changes since the last commit in journal mode : id -> 'put'
+        # or 'delete'
+        self.pending = {}
 
     def create(self,*fields,**kw):
         """Create a new base with specified field names
@@ -178,38 +296,45 @@ class Base:
         self.records = {}
         self.next_id = 0
         self.indices = {}
-        self.commit()
+        self.checkpoint()
         return self
 
-    def create_index(self,*fields):
+    def create_index(self,*fields,**kw):
         """Create an index on the specified field names
         
         An index on a field is a mapping between the values taken by the field
         and the sorted list of the ids of the records whose field is equal to 
         this value
+
+        A keyword argument kind can be specified :
+        - if kind = 'bisect' (default) : ids are kept in sorted lists
+        - if kind = 'hash' : ids are kept in sets, which is faster to
+        update when many records share the same value
         
         For each indexed field, an attribute of self is created, an instance 
         of the class Index (see above). Its name it the field name, with the
         prefix _ to avoid name conflicts
         """
+        kind = kw.get("kind","bisect")
+        if not kind in INDEX_KINDS:
+            raise ValueError,"Unknown index kind %s" %kind
         reset = False
         for f in fields:
             if not f in self.fields:
                 raise NameError,"%s is not a field name %s" %(f,self.fields)
             # initialize the indices
-            if self.mode == "open" and f in self.indices:
+            if self.mode == "open" and f in self.indices and \
+                type(self.indices[f]) is INDEX_KINDS[kind]:
                 continue
             reset = True
-            self.indices[f] = {}
+            self.indices[f] = INDEX_KINDS[kind]()
             for _id,record in self.records.iteritems():
-                # use bisect to quickly insert the id in the list
-                bisect.insort(self.indices[f].setdefault(record[f],[]),
-                    _id)
+                self._index_add(f,record[f],_id)
             # create a new attribute of self, used to find the records
             # by this index
             setattr(self,'_'+f,Index(self,f))
         if reset:
-            self.commit()
+            self.checkpoint()
 
     def delete_index(self,*fields):
         """Delete the index on the specified fields"""
@@ -218,33 +343,171 @@ class Base:
                 raise ValueError,"No index on field %s" %f
         for f in fields:
             del self.indices[f]
-        self.commit()
+        self.checkpoint()
 
     def open(self):
-        """Open an existing database and load its content into memory"""
+        """Open an existing database and load its content into memory
+        Files in the lazy mode layout can be opened in both modes ; if
+        the base isn't lazy all the records are loaded"""
         # guess protocol
         if self.protocol==0:
             _in = open(self.name) # don't specify binary mode !
         else:
             _in = open(self.name,'rb')
-        self.fields = cPickle.load(_in)
-        self.next_id = cPickle.load(_in)
-        self.records = cPickle.load(_in)
-        self.indices = cPickle.load(_in)
+        if _in.read(len(LAZY_MAGIC)) == LAZY_MAGIC:
+            self._open_lazy(_in)
+        else:
+            _in.seek(0)
+            self.fields = cPickle.load(_in)
+            self.next_id = cPickle.load(_in)
+            self.records = cPickle.load(_in)
+            self.indices = cPickle.load(_in)
         for f in self.indices.keys():
             setattr(self,'_'+f,Index(self,f))
         _in.close()
+        self._replay_journal()
         self.mode = "open"
         return self
 
+    def _replay_journal(self):
+        """Apply the operations in the journal, if there is one. An
+        incomplete commit at the end, from a crash in the middle of
+        writing it, is discarded"""
+        try:
+            _in = open(self.journal_name,'rb')
+        except IOError,e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        end = 0
+        while True:
+            try:
+                ops = cPickle.load(_in)
+            except EOFError:
+                break
+            except Exception:
+                # truncated or garbled commit
+                break
+            end = _in.tell()
+            for op,arg in ops:
+                if op == 'put':
+                    _id = arg['__id__']
+                    if _id in self.records:
+                        self._unindex_record(self.records[_id])
+                    self.records[_id] = arg
+                    self._index_record(arg)
+                    self.next_id = max(self.next_id,_id+1)
+                elif op == 'delete':
+                    if arg in self.records:
+                        self._unindex_record(self.records[arg])
+                        del self.records[arg]
+                elif op == 'next_id':
+                    self.next_id = max(self.next_id,arg)
+        _in.seek(0,2)
+        size = _in.tell()
+        _in.close()
+        if end < size:
+            out = open(self.journal_name,'r+b')
+            out.truncate(end)
+            out.close()
+
+    def _open_lazy(self,_in,loaded=None):
+        meta_offset, = LAZY_HEADER.unpack(_in.read(LAZY_HEADER.size))
+        data = mmap.mmap(_in.fileno(),0,access=mmap.ACCESS_READ)
+        self.fields,self.next_id,self.indices,offsets = \
+            cPickle.loads(data[meta_offset:])
+        # records already in memory don't need to be read from the file
+        for _id in loaded or {}:
+            del offsets[_id]
+        self.records = LazyRecords(data,offsets,loaded)
+        if not self.lazy:
+            self.records = dict(self.records.iteritems())
+
     def commit(self):
-        """Write the database to a file"""
-        out = open(self.name,'wb')
-        cPickle.dump(self.fields,out,self.protocol)
-        cPickle.dump(self.next_id,out,self.protocol)
-        cPickle.dump(self.records,out,self.protocol)
-        cPickle.dump(self.indices,out,self.protocol)
+        """Write the database to a file
+        In journal mode, only append the changes since the last commit
+        to the journal, unless it has grown beyond journal_size"""
+        if self.journal:
+            self._append_journal()
+            if os.path.getsize(self.journal_name) < self.journal_size:
+                return
+        self.checkpoint()
+
+    def _append_journal(self):
+        ops = []
+        for _id,op in self.pending.iteritems():
+            if op == 'put':
+                ops.append(('put',self.records[_id]))
+            else:
+                ops.append(('delete',_id))
+        ops.append(('next_id',self.next_id))
+        out = open(self.journal_name,'ab')
+        cPickle.dump(ops,out,self.protocol)
+        out.flush()
+        os.fsync(out.fileno())
         out.close()
+        self.pending = {}
+
+    def checkpoint(self):
+        """Write the whole database to a file and empty the journal"""
+        if self.journal and self.pending:
+            # journal the changes first, so that the journal always
+            # matches the new base if we crash before removing it
+            self._append_journal()
+        if self.lazy:
+            self._commit_lazy()
+        else:
+            tmp_name = self.name + '.tmp'
+            out = open(tmp_name,'wb')
+            cPickle.dump(self.fields,out,self.protocol)
+            cPickle.dump(self.next_id,out,self.protocol)
+            cPickle.dump(self.records,out,self.protocol)
+            cPickle.dump(self.indices,out,self.protocol)
+            out.flush()
+            os.fsync(out.fileno())
+            out.close()
+            os.rename(tmp_name,self.name)
+        self.pending = {}
+        # if we crash before this, the journal is replayed on top of
+        # the new base, which doesn't change anything
+        if os.path.exists(self.journal_name):
+            os.remove(self.journal_name)
+
+    def _commit_lazy(self):
+        """Write the database in the lazy mode layout. Records that were
+        never loaded are copied as they are, without unpickling them"""
+        tmp_name = self.name + '.tmp'
+        out = open(tmp_name,'wb')
+        out.write(LAZY_MAGIC)
+        out.write(LAZY_HEADER.pack(0))
+        offsets = {}
+        is_lazy = isinstance(self.records,LazyRecords)
+        for _id in self.records.keys():
+            if is_lazy and _id in self.records.offsets:
+                data = self.records.raw(_id)
+            else:
+                data = cPickle.dumps(self.records[_id],self.protocol)
+            offsets[_id] = (out.tell(),len(data))
+            out.write(data)
+        meta_offset = out.tell()
+        cPickle.dump((self.fields,self.next_id,self.indices,offsets),
+            out,self.protocol)
+        out.seek(len(LAZY_MAGIC))
+        out.write(LAZY_HEADER.pack(meta_offset))
+        out.flush()
+        os.fsync(out.fileno())
+        out.close()
+        # the new file replaces the old one atomically, the mmap of the
+        # old one stays valid until it is replaced below
+        os.rename(tmp_name,self.name)
+        if is_lazy:
+            loaded = self.records.loaded
+        else:
+            loaded = self.records
+        _in = open(self.name,'rb')
+        _in.seek(len(LAZY_MAGIC))
+        self._open_lazy(_in,loaded)
+        _in.close()
 
     def insert(self,*args,**kw):
         """Insert a record in the database
@@ -271,9 +534,9 @@ class Base:
         # create an entry in the dictionary self.records, indexed by __id__
         self.records[self.next_id] = record
         # update index
-        for ix in self.indices.keys():
-            bisect.insort(self.indices[ix].setdefault(record[ix],[]),
-                self.next_id)
+        self._index_record(record)
+        if self.journal:
+            self.pending[self.next_id] = 'put'
         # increment the next __id__
         self.next_id += 1
         return record['__id__']
@@ -294,10 +557,9 @@ class Base:
             return 0
         _ids = [ r['__id__'] for r in removed ]
         _ids.sort()
-        keys = set(self.records.keys())
         # check if the records are in the base
-        if not set(_ids).issubset(keys):
-            missing = list(set(_ids).difference(keys))
+        missing = [ _id for _id in _ids if not _id in self.records ]
+        if missing:
             raise IndexError,'Delete aborted. Records with these ids' \
                 ' not found in the base : %s' %str(missing)
         # raise exception if duplicate ids
@@ -309,15 +571,39 @@ class Base:
             r = removed.pop()
             _id = r['__id__']
             # remove id from indices
-            for indx in self.indices.keys():
-                pos = bisect.bisect(self.indices[indx][r[indx]],_id)-1
-                del self.indices[indx][r[indx]][pos]
-                if not self.indices[indx][r[indx]]:
-                    del self.indices[indx][r[indx]]
+            self._unindex_record(r)
             # remove record from self.records
             del self.records[_id]
+            if self.journal:
+                self.pending[_id] = 'delete'
         return deleted
 
+    def _index_record(self,record):
+        for ix in self.indices.keys():
+            self._index_add(ix,record[ix],record['__id__'])
+
+    def _unindex_record(self,record):
+        for ix in self.indices.keys():
+            self._index_remove(ix,record[ix],record['__id__'])
+
+    def _index_add(self,field,value,_id):
+        index = self.indices[field]
+        if isinstance(index,HashIndex):
+            index.setdefault(value,set()).add(_id)
+        else:
+            # use bisect to quickly insert the id in the list
+            bisect.insort(index.setdefault(value,[]),_id)
+
+    def _index_remove(self,field,value,_id):
+        index = self.indices[field]
+        ids = index[value]
+        if isinstance(index,HashIndex):
+            ids.remove(_id)
+        else:
+            del ids[bisect.bisect(ids,_id)-1]
+        if not ids:
+            del index[value]
+
     def update(self,records,**kw):
         """Update one record of a list of records 
         with new keys and values and update indices"""
@@ -332,17 +618,16 @@ class Base:
                     continue
                 _id = record["__id__"]
                 # remove id for the old value
-                old_pos = bisect.bisect(self.indices[indx][record[indx]],_id)-1
-                del self.indices[indx][record[indx]][old_pos]
-                if not self.indices[indx][record[indx]]:
-                    del self.indices[indx][record[indx]]
+                self._index_remove(indx,record[indx],_id)
                 # insert new value
-                bisect.insort(self.indices[indx].setdefault(kw[indx],[]),_id)
+                self._index_add(indx,kw[indx],_id)
         for record in records:
             # update record values
             record.update(kw)
             # increment version number
             record["__version__"] += 1
+            if self.journal:
+                self.pending[record["__id__"]] = 'put'
 
     def add_field(self,field,default=None):
         if field in self.fields + ["__id__","__version__"]:
@@ -350,7 +635,7 @@ class Base:
         for r in self:
             r[field] = default
         self.fields.append(field)
-        self.commit()
+        self.checkpoint()
     
     def drop_field(self,field):
         if field in ["__id__","__version__"]:
@@ -360,7 +645,7 @@ class Base:
             del r[field]
         if field in self.indices:
             del self.indices[field]
-        self.commit()
+        self.checkpoint()
 
     def __call__(self,*args,**kw):
         """Selection by field values
@@ -1,11 +1,12 @@
-import boto.ec2
-import boto
+import os
+import errno
 import datetime
 import dateutil.parser
 import time
 import sys
 import re
-import requests
+import collections
+import operator
 import simplejson as json
 
 from fabric.api import * # pylint: disable=W0614,W0401
@@ -13,30 +14,39 @@ import fabric.api as fab
 
 import headintheclouds
 from headintheclouds import util, cache
-from headintheclouds.tasks import cloudtask
+from headintheclouds.tasks import cloudtask, localtask
+
+boto_ec2 = util.lazy_import('boto.ec2')
+requests = util.lazy_import('requests')
+numpy = util.lazy_import('numpy')
 
 __all__ = ['spot_requests', 'cancel_spot_request', 'mount_volume']
 
-@task
-@runs_once
+@localtask
 def spot_requests():
     '''
     List all active spot instance requests.
     '''
-    requests = _ec2().get_all_spot_instance_requests()
-    util.print_table(requests, ['id', ('bid', 'price'), 'create_time',
-                                'state', 'status', 'instance_id'])
-
-@task
-@runs_once
-def cancel_spot_request(request_id):
+    def region_requests(region):
+        requests = _ec2(region).get_all_spot_instance_requests()
+        for request in requests:
+            request.region_name = region
+        return requests
+
+    requests = sum(util.parallel_map(region_requests, REGIONS), [])
+    util.print_table(requests, ['id', ('region', 'region_name'), ('bid', 'price'),
+                                'create_time', 'state', 'status', 'instance_id'])
+
+@localtask
+def cancel_spot_request(request_id, region=None):
     '''
     Cancel a spot instance request.
 
     Args:
         request_id (str): Request ID
+        region (str): default the first region in AWS_REGIONS
     '''
-    _ec2().cancel_spot_instance_requests([request_id])
+    _ec2(region).cancel_spot_instance_requests([request_id])
 
 @cloudtask
 def mount_volume(volume, device='/dev/xvdf', mountpoint='/mnt/data', fstype='ext4'):
@@ -49,19 +59,26 @@ def mount_volume(volume, device='/dev/xvdf', mountpoint='/mnt/data', fstype='ext
         mountpoint (str): default /mnt/data
         fstype (str): default ext4
     '''
-    _ec2().attach_volume(volume, _host_node()['id'], device)
+    node = _host_node()
+    _ec2(node['region']).attach_volume(volume, node['id'], device)
     time.sleep(1)
     sudo('mkdir -p "%s"' % mountpoint)
     sudo('mount -t "%s" "%s" "%s"' % (fstype, device, mountpoint))
 
-@task
-@runs_once
+@localtask
 def create_volume(size, zone, snapshot_id=None):
-    _ec2().create_volume(size=size, zone=zone, snapshot=snapshot_id)
+    _ec2(_zone_region(zone)).create_volume(size=size, zone=zone, snapshot=snapshot_id)
+
+# regions to manage servers in, e.g. AWS_REGIONS=us-east-1,eu-west-1.
+# the first one is used for anything that isn't given a region
+REGIONS = [r.strip() for r in os.environ.get('AWS_REGIONS', 'us-east-1').split(',')
+           if r.strip()]
+DEFAULT_REGION = REGIONS[0]
+DEFAULT_PLACEMENT = os.environ.get('AWS_DEFAULT_PLACEMENT', '%sb' % DEFAULT_REGION)
 
 create_server_defaults = {
     'size': 'm1.small',
-    'placement': 'us-east-1b',
+    'placement': DEFAULT_PLACEMENT,
     'bid': '',
     'image': 'ubuntu 14.04',
     'security_group': 'default',
@@ -73,98 +90,223 @@ def create_servers(count, names=None, size=None, placement=None,
     assert count == len(names)
 
     image = _unalias_image(image)
-    
-    if bid:
-        instance_ids = create_spot_instances(
-            count=count, size=size, placement=placement,
+    sizes = _split_options(size)
+    zones = _split_options(placement)
+    # a single size or zone may be a one item list too
+    if len(sizes) == 1:
+        size = sizes[0]
+    if len(zones) == 1:
+        placement = zones[0]
+
+    if bid and (len(sizes) > 1 or len(zones) > 1):
+        instance_ids = create_cheapest_spot_instances(
+            count=count, sizes=sizes, zones=zones,
             image=image, names=names, bid=bid,
             security_group=security_group)
+    elif bid:
+        instance_ids = {_zone_region(placement): create_spot_instances(
+            count=count, size=size, placement=placement,
+            image=image, names=names, bid=bid,
+            security_group=security_group)}
     else:
-        instance_ids = create_on_demand_instances(
+        instance_ids = {_zone_region(placement): create_on_demand_instances(
             count=count, size=size, placement=placement,
             image=image, names=names,
-            security_group=security_group)
+            security_group=security_group)}
 
-    wait_for_instances_to_become_accessible(instance_ids)
-    nodes = [n for n in all_nodes() if n['id'] in instance_ids]
+    def wait(region):
+        return wait_for_instances_to_become_accessible(instance_ids[region], region)
+    nodes = sum(util.parallel_map(wait, instance_ids), [])
+    cache.uncache(all_nodes)
     return nodes
 
-def pricing(sort='cost', zone='us-east-1a'):
-    now = datetime.datetime.now()
-    one_day_ago = now - datetime.timedelta(days=1)
-    price_history = _ec2().get_spot_price_history(
-        start_time=one_day_ago.isoformat(),
-        end_time=now.isoformat(),
-        product_description='Linux/UNIX',
-        availability_zone=zone,
-    )
-
-    data = {}
-    latest_price = {}
-    latest_time = {}
-    for item in price_history:
-        t = item.instance_type
-
-        if t not in data:
-            data[t] = []
-            latest_time[t] = item.timestamp
-            latest_price[t] = item.price
-        else:
-            if latest_time[t] < item.timestamp:
-                latest_time[t] = item.timestamp
-                latest_price[t] = item.price
+def pricing(sort='cost', zone=None, zones=None):
+    '''
+    zones is a list, or a string separated by semicolons, of zones to
+    show spot prices for instead of zone, which defaults to
+    DEFAULT_PLACEMENT. They're looked up at the same time.
+    '''
+    if zones is None:
+        zones = [zone or DEFAULT_PLACEMENT]
+    elif isinstance(zones, basestring):
+        zones = [z.strip() for z in zones.split(';') if z.strip()]
 
-        data[t].append(item.price)
+    histories = util.parallel_map(spot_price_history, zones)
+    stats = spot_price_stats(dict(zip(zones, histories)))
 
     table = []
     node_types = get_node_types()
     for t, node_type in node_types.items():
-        item = node_type.copy()
-        item['size'] = t
-        if t in data:
-            prices = data[t]
-            item['recent'] = round(latest_price[t], 3)
-            item['median'] = round(util.median(prices), 3)
-            item['stddev'] = round(util.stddev(prices), 3)
-            item['max'] = round(max(prices), 3)
-        table.append(item)
-
-    util.print_table(table, ['size', 'memory', 'cores', 'storage', 'gpu', 'recent',
-                             'median', 'stddev', 'max', ('cost', 'linux_cost')], 
-                     sort=sort, default_sort='memory')
+        for z in zones:
+            item = node_type.copy()
+            item['size'] = t
+            item['zone'] = z
+            if (z, t) in stats:
+                for column, value in stats[(z, t)].items():
+                    item[column] = round(value, 3)
+            table.append(item)
+
+    columns = ['size', 'memory', 'cores', 'storage', 'gpu', 'recent',
+               'median', 'stddev', 'max', ('cost', 'linux_cost')]
+    if len(zones) > 1:
+        columns.insert(1, 'zone')
+    util.print_table(table, columns, sort=sort, default_sort='memory')
+
+def spot_price_history(zone):
+    '''
+    Return the last SPOT_HISTORY_DAYS of Linux spot prices in zone as a
+    list of (timestamp, instance type, price), oldest first. The history
+    is kept in the cache, and only the prices since the last call are
+    fetched.
+    '''
+    key = cache.make_key(spot_price_history, [zone], namespace=['ec2', ACCESS_KEY_ID])
+    cached = cache.get(key)
+    now = time.time()
+    start = now - SPOT_HISTORY_DAYS * 24 * 60 * 60
+    if cached is None or cached['end'] < start:
+        cached = {'end': start, 'history': []}
+
+    # EC2 also returns the price in effect at the start time, so the
+    # last price of each type comes back again
+    history = dict(((t, instance_type), price)
+                   for t, instance_type, price in cached['history'])
+    for item in _spot_prices(zone, _timestamp(cached['end']), _timestamp(now)):
+        history[(item.timestamp, item.instance_type)] = item.price
+
+    # prices that changed before the start of the window are kept if
+    # they're still the current price of their type
+    history = sorted((t, instance_type, price)
+                     for (t, instance_type), price in history.items())
+    latest = set({instance_type: i for i, (_, instance_type, _)
+                  in enumerate(history)}.values())
+    start_time = _timestamp(start)
+    history = [row for i, row in enumerate(history)
+               if row[0] >= start_time or i in latest]
+
+    cache.set(key, {'end': now, 'history': history},
+              ttl=SPOT_HISTORY_DAYS * 24 * 60 * 60)
+    return history
+
+def spot_price_stats(histories):
+    '''
+    Given a dict of zone to spot_price_history(zone), return a dict of
+    (zone, instance type) to the recent, median, stddev and max price
+    of that type in that zone.
+    '''
+    keys = []
+    groups = []
+    prices = []
+    for zone, history in histories.items():
+        instance_types = map(operator.itemgetter(1), history)
+        index = {t: len(keys) + i for i, t in enumerate(set(instance_types))}
+        keys += [(zone, t) for t in sorted(index, key=index.get)]
+        groups.append(numpy.array(map(index.__getitem__, instance_types), dtype=int))
+        prices.append(numpy.array(map(operator.itemgetter(2), history), dtype=float))
+    if not keys:
+        return {}
+    groups = numpy.concatenate(groups)
+    prices = numpy.concatenate(prices)
+
+    counts = numpy.bincount(groups)
+    first = numpy.cumsum(counts) - counts
+    last = first + counts - 1
+
+    # the histories are oldest first, and a stable sort keeps them that
+    # way within each group
+    by_time = prices[numpy.argsort(groups, kind='mergesort')]
+    by_price = prices[numpy.lexsort((prices, groups))]
+    mean = numpy.bincount(groups, prices) / counts
+    variance = numpy.bincount(groups, (prices - mean[groups]) ** 2) / counts
+
+    columns = {
+        'recent': by_time[last],
+        'median': by_price[first + counts // 2],
+        'stddev': numpy.sqrt(variance),
+        'max': by_price[last],
+    }
+    return {key: {c: float(v[i]) for c, v in columns.items()}
+            for i, key in enumerate(keys)}
+
+def _spot_prices(zone, start_time, end_time):
+    connection = _ec2_paginated(_zone_region(zone))
+    params = {
+        'StartTime': start_time,
+        'EndTime': end_time,
+        'ProductDescription': 'Linux/UNIX',
+        'AvailabilityZone': zone,
+        'MaxResults': PAGE_SIZE,
+    }
+    while True:
+        prices = connection.get_list(
+            'DescribeSpotPriceHistory', params,
+            [('item', boto_ec2.spotpricehistory.SpotPriceHistory)], verb='POST')
+        for price in prices:
+            yield price
+
+        next_token = getattr(prices, 'nextToken', None)
+        if not next_token:
+            break
+        params['NextToken'] = next_token
+
+def _timestamp(t):
+    # EC2's timestamp format, which sorts like the times themselves
+    return datetime.datetime.utcfromtimestamp(t).strftime('%Y-%m-%dT%H:%M:%S.000Z')
 
 def terminate():
-    instance_id = _host_node()['id']
-    print 'Terminating EC2 instance %s' % instance_id
-    _ec2().terminate_instances([instance_id])
+    terminate_nodes([_host_node()])
+
+def terminate_nodes(nodes):
+    for region, ids in _ids_by_region(nodes).items():
+        print 'Terminating EC2 instances %s' % ', '.join(ids)
+        _ec2(region).terminate_instances(ids)
     cache.uncache(all_nodes)
 
 def reboot():
-    instance_id = _host_node()['id']
-    print 'Rebooting EC2 instance %s' % instance_id
-    _ec2().reboot_instances([instance_id])
+    reboot_nodes([_host_node()])
+
+def reboot_nodes(nodes):
+    for region, ids in _ids_by_region(nodes).items():
+        print 'Rebooting EC2 instances %s' % ', '.join(ids)
+        _ec2(region).reboot_instances(ids)
 
 def nodes():
-    nodes = cache.recache(all_nodes)
+    nodes = all_nodes()
     util.print_table(nodes, ['name', 'size', 'ip', 'internal_ip', 'state', 'created'], sort='name')
 
 
-def wait_for_instances_to_become_accessible(instance_ids):
-    while True:
-        nodes_ready = 0
-        nodes = cache.recache(all_nodes)
-        nodes = [n for n in nodes if n['id'] in instance_ids]
-        for node in nodes:
-            with fab.settings(hide('everything'), warn_only=True):
-                result = local('nc -w 5 -zvv %s 22' % node['ip'])
-            if result.return_code == 0:
-                nodes_ready += 1
-        if nodes_ready == len(instance_ids):
-            return
+def wait_for_instances_to_become_accessible(instance_ids, region=None):
+    '''
+    Wait until all instances accept SSH connections, and return their
+    nodes.
+    '''
+    for delay in util.backoff():
+        nodes = _nodes_by_id(instance_ids, region)
+        ips = [n['ip'] for n in nodes if n['ip']]
+        if len(util.reachable(ips, 22)) == len(instance_ids):
+            return nodes
 
         print 'Waiting for instance%s to become accessible' % (
             's' if len(instance_ids) > 1 else '')
-        time.sleep(5)
+        time.sleep(delay)
+
+def wait_for_instances_to_start(instance_ids, region=None):
+    for delay in util.backoff():
+        states = _instance_states(instance_ids, region)
+        # new instances can take a moment to show up
+        statuses = [states.get(i, 'pending') for i in instance_ids]
+        if all(s == 'running' for s in statuses):
+            return
+
+        status_counts = [(status, statuses.count(status))
+                         for status in sorted(set(statuses))]
+        if len(instance_ids) > 1:
+            print 'Waiting for instances to start [%s]' % (
+                ', '.join(['%s: %d' % s for s in status_counts]))
+        else:
+            print 'Waiting for instance to start [%s]' % (statuses[0])
+
+        # TODO: handle error
+        time.sleep(delay)
 
 def create_on_demand_instances(count, size, placement, image, names, security_group):
     if count > 1:
@@ -172,7 +314,8 @@ def create_on_demand_instances(count, size, placement, image, names, security_gr
     else:
         print 'Creating EC2 %s instance' % size
 
-    reservation = _ec2().run_instances(
+    region = _zone_region(placement)
+    reservation = _ec2(region).run_instances(
         image_id=image,
         min_count=count,
         max_count=count,
@@ -182,24 +325,10 @@ def create_on_demand_instances(count, size, placement, image, names, security_gr
         key_name=KEYPAIR_NAME,
     )
 
-    for instance, name in zip(reservation.instances, names):
-        _set_instance_name(instance.id, name)
-
-    while any([i.state != 'running' for i in reservation.instances]):
-        statuses = [i.state for i in reservation.instances]
-        status_counts = [(status, statuses.count(status))
-                         for status in sorted(set(statuses))]
-        if count > 1:
-            print 'Waiting for instances to start [%s]' % (
-                ', '.join(['%s: %d' % s for s in status_counts]))
-        else:
-            print 'Waiting for instance to start [%s]' % (statuses[0])
-        
-        # TODO: handle error
-        time.sleep(5)
-        [i.update() for i in reservation.instances]
-
-    return [i.id for i in reservation.instances]
+    instance_ids = [i.id for i in reservation.instances]
+    _set_instance_names(instance_ids, names, region)
+    wait_for_instances_to_start(instance_ids, region)
+    return instance_ids
 
 def create_spot_instances(count, size, placement, image, names, bid, security_group):
     bid = float(bid)
@@ -210,7 +339,8 @@ def create_spot_instances(count, size, placement, image, names, bid, security_gr
     else:
         print 'Creating spot request %s instance at $%.3f' % (size, bid)
 
-    requests = _ec2().request_spot_instances(
+    region = _zone_region(placement)
+    requests = _ec2(region).request_spot_instances(
         price=bid,
         image_id=image,
         count=count,
@@ -222,10 +352,10 @@ def create_spot_instances(count, size, placement, image, names, bid, security_gr
 
     request_ids = [r.id for r in requests]
 
-    while True:
-        time.sleep(5)
-        
-        requests = _ec2().get_all_spot_instance_requests(request_ids)
+    for delay in util.backoff():
+        time.sleep(delay)
+
+        requests = _ec2(region).get_all_spot_instance_requests(request_ids)
 
         statuses = [r.status.code for r in requests]
         status_counts = [(status, statuses.count(status))
@@ -241,22 +371,106 @@ def create_spot_instances(count, size, placement, image, names, bid, security_gr
         if all([status == 'fulfilled' for status in statuses]):
             break
 
-        if all([status == 'price-too-low']):
+        if all(status == 'price-too-low' for status in statuses):
             abort('Price too low')
 
     active_requests = [r for r in requests if r.state == 'active']
     instance_ids = [r.instance_id for r in active_requests]
-    for instance_id, name in zip(instance_ids, names):
-        _set_instance_name(instance_id, name)
+    _set_instance_names(instance_ids, names, region)
+
+    return instance_ids
+
+def create_cheapest_spot_instances(count, sizes, zones, image, names, bid, security_group):
+    '''
+    Request count spot instances in each of the SPOT_CANDIDATES
+    combinations of sizes and zones with the lowest current spot price,
+    all at the same time. Once count requests are fulfilled the
+    cheapest are kept, and the other requests are cancelled and their
+    instances terminated. If there aren't enough after SPOT_DEADLINE
+    seconds, the rest are created on demand. Returns a dict of region
+    to instance IDs.
+    '''
+    bid = float(bid)
+    candidates = _spot_candidates(sizes, zones, bid)[:SPOT_CANDIDATES]
+
+    # request ID -> (rank of its candidate, region)
+    spot_requests = {}
+    if candidates:
+        print 'Creating spot requests for %d instances in each of %s' % (
+            count, ', '.join('%s %s ($%.3f)' % (size, zone, price)
+                             for price, size, zone in candidates))
+
+        def request(candidate):
+            price, size, zone = candidate
+            return _ec2(_zone_region(zone)).request_spot_instances(
+                price=bid,
+                image_id=image,
+                count=count,
+                security_groups=[security_group],
+                instance_type=size,
+                placement=zone,
+                key_name=KEYPAIR_NAME,
+            )
+        for rank, requests in enumerate(util.parallel_map(request, candidates)):
+            for r in requests:
+                spot_requests[r.id] = (rank, _zone_region(candidates[rank][2]))
+    else:
+        print 'No spot prices are below $%.3f' % bid
+
+    # request ID -> instance ID
+    fulfilled = {}
+    deadline = time.time() + SPOT_DEADLINE
+    for delay in util.backoff():
+        if not spot_requests or time.time() >= deadline:
+            break
+        time.sleep(max(0, min(delay, deadline - time.time())))
+
+        for r in _spot_requests_by_id(spot_requests):
+            if r.state == 'active' and r.instance_id:
+                fulfilled[r.id] = r.instance_id
+
+        print 'Waiting for spot requests to be fulfilled [%d of %d]' % (
+            min(len(fulfilled), count), count)
+        if len(fulfilled) >= count:
+            break
+
+    kept = sorted(fulfilled, key=lambda r: spot_requests[r][0])[:count]
+    losers = [r for r in spot_requests if r not in kept]
+    if losers:
+        _cancel_spot_requests(losers, spot_requests)
+
+    instance_ids = collections.OrderedDict()
+    for r in kept:
+        instance_ids.setdefault(spot_requests[r][1], []).append(fulfilled[r])
+    named = 0
+    for region, ids in instance_ids.items():
+        _set_instance_names(ids, names[named:named + len(ids)], region)
+        named += len(ids)
+
+    if len(kept) < count:
+        size, placement = _on_demand_fallback(sizes, zones, candidates)
+        print 'Creating %d on demand instances instead' % (count - len(kept))
+        ids = create_on_demand_instances(
+            count=count - len(kept), size=size, placement=placement,
+            image=image, names=names[len(kept):], security_group=security_group)
+        instance_ids.setdefault(_zone_region(placement), []).extend(ids)
 
     return instance_ids
 
 def validate_create_options(size, placement, bid, image, security_group, prefer_ebs=False):
     updates = {}
 
-    # don't validate size for now, sizes get out of date really quickly
-    # if size is not None and size not in get_node_types():
-    #     raise Exception('Unknown EC2 instance size: "%s"' % size)
+    node_types = get_node_types()
+    for s in _split_options(size):
+        if s not in node_types:
+            # the snapshot that comes with headintheclouds doesn't know
+            # about newer sizes
+            if getattr(get_node_types, 'downloaded', False):
+                raise Exception('Unknown EC2 instance size: "%s"' % s)
+            warn('Unknown EC2 instance size: "%s"' % s)
+
+    if not bid and (len(_split_options(size)) > 1 or len(_split_options(placement)) > 1):
+        raise Exception('Several sizes or placements need a bid')
 
     if size is None:
         raise Exception('You need to specify a size')
@@ -264,24 +478,50 @@ def validate_create_options(size, placement, bid, image, security_group, prefer_
     if image is None:
         raise Exception('You need to specify an image')
 
+    if image.lower() in IMAGE_ALIASES:
+        regions = set(_zone_region(z) for z in _split_options(placement)) or set([DEFAULT_REGION])
+        other_regions = sorted(regions - set([IMAGE_ALIAS_REGION]))
+        if other_regions:
+            raise Exception('Image "%s" is an alias for an AMI in %s, specify an AMI ID for %s'
+                            % (image, IMAGE_ALIAS_REGION, ', '.join(other_regions)))
+
     updates['image'] = _unalias_image(image)
 
     return updates
 
 def rename(name):
     current_node = _host_node()
-    _set_instance_name(current_node['id'], name)
+    _set_instance_name(current_node['id'], name, current_node['region'])
 
-@cache.cached
 def get_node_types():
+    '''
+    Return a dict of instance size to its specs and on-demand Linux
+    price. The catalog is read from NODE_TYPES_FILENAME, or the snapshot
+    that comes with headintheclouds until that exists, and refreshed
+    with a conditional GET once it's NODE_TYPES_TTL seconds old. Without
+    a network connection the catalog as it is is used, and the download
+    is tried again NODE_TYPES_TTL seconds later. get_node_types.downloaded
+    is False if the catalog was never downloaded.
+    '''
+    if not hasattr(get_node_types, 'node_types'):
+        filename = os.path.expanduser(NODE_TYPES_FILENAME)
+        catalog = _read_node_types(filename) or _read_node_types(NODE_TYPES_SNAPSHOT)
+        try:
+            age = time.time() - os.path.getmtime(filename)
+        except OSError:
+            age = None
+        if age is None or age > NODE_TYPES_TTL:
+            catalog = _refresh_node_types(catalog, filename)
+
+        get_node_types.downloaded = bool(catalog['etag'] or catalog['last_modified'])
+        get_node_types.node_types = {
+            size: dict(zip(catalog['columns'], values))
+            for size, values in catalog['node_types'].items()}
+    return get_node_types.node_types
+
+def parse_node_types(data):
     node_types = {}
 
-    r = requests.get('http://aws-assets-pricing-prod.s3.amazonaws.com/pricing/ec2/linux-od.js')
-    if not r:
-        return {}
-
-    data = parse_jsonp(r.content)
-
     instance_types = [r['instanceTypes'] for r in data['config']['regions']
                       if r['region'] == 'us-east'][0]
     for instance_type in instance_types:
@@ -302,29 +542,116 @@ def get_node_types():
 
     return node_types
 
+def _refresh_node_types(catalog, filename):
+    # only download the catalog if it's changed since the one we have
+    headers = {}
+    if catalog['etag']:
+        headers['If-None-Match'] = catalog['etag']
+    if catalog['last_modified']:
+        headers['If-Modified-Since'] = catalog['last_modified']
+    try:
+        r = requests.get(NODE_TYPES_URL, headers=headers, timeout=NODE_TYPES_TIMEOUT)
+    except requests.RequestException:
+        r = None
+
+    if r is None or r.status_code == 304 or not r:
+        # rewriting the catalog we have resets its age, so that when
+        # the download fails other processes don't all retry it until
+        # NODE_TYPES_TTL has passed again
+        _write_node_types(catalog, filename)
+        return catalog
+
+    node_types = parse_node_types(parse_jsonp(r.content))
+    catalog = {
+        'version': NODE_TYPES_VERSION,
+        'etag': r.headers.get('ETag'),
+        'last_modified': r.headers.get('Last-Modified'),
+        'columns': NODE_TYPE_COLUMNS,
+        'node_types': {size: [node_type[c] for c in NODE_TYPE_COLUMNS]
+                       for size, node_type in node_types.items()},
+    }
+    _write_node_types(catalog, filename)
+    return catalog
+
+def _read_node_types(filename):
+    try:
+        with open(filename) as f:
+            catalog = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if catalog.get('version') != NODE_TYPES_VERSION:
+        return None
+    return catalog
+
+def _write_node_types(catalog, filename):
+    try:
+        os.makedirs(os.path.dirname(filename))
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    # written to a temporary file first, so other processes never
+    # read half a catalog
+    temp_filename = '%s.%d' % (filename, os.getpid())
+    with open(temp_filename, 'w') as f:
+        json.dump(catalog, f, sort_keys=True, separators=(',', ':'))
+    os.rename(temp_filename, filename)
+
 def parse_jsonp(content):
     insides = content.split('callback(', 1)[1].rsplit(')')[0]
     return json.loads(insides)
 
-@cache.cached
+def _cache_namespace():
+    return ['ec2', ACCESS_KEY_ID, REGIONS, env.name_prefix]
+
+@cache.cached(ttl=60, stale_ttl=None, namespace=_cache_namespace)
 def all_nodes():
-    reservations = _ec2().get_all_instances()
-    nodes = [instance_to_node(x)
-             for r in reservations for x in r.instances
-             if (env.name_prefix == '' or (
-                     'Name' in x.tags
-                     and x.tags['Name'].startswith(env.name_prefix)
-             ))
-             and x.state not in ('terminated', 'shutting-down')]
-    return nodes
+    filters = {'instance-state-name': LIVE_STATES}
+    if env.name_prefix:
+        # escape EC2's filter wildcards in the prefix itself
+        filters['tag:Name'] = re.sub(r'([*?\\])', r'\\\1', env.name_prefix) + '*'
+
+    def region_nodes(region):
+        return [instance_to_node(x)
+                for x in _all_instances(region, filters)
+                if (env.name_prefix == '' or (
+                        'Name' in x.tags
+                        and x.tags['Name'].startswith(env.name_prefix)
+                ))
+                and x.state in LIVE_STATES]
+
+    # query all regions at the same time
+    return sum(util.parallel_map(region_nodes, REGIONS), [])
+
+def _all_instances(region, filters):
+    '''
+    Yield the instances in a region matching the DescribeInstances
+    filters, one page at a time.
+    '''
+    connection = _ec2_paginated(region)
+    params = {'MaxResults': PAGE_SIZE}
+    connection.build_filter_params(params, filters)
+    while True:
+        reservations = connection.get_list(
+            'DescribeInstances', params,
+            [('item', boto_ec2.instance.Reservation)], verb='POST')
+        for reservation in reservations:
+            for instance in reservation.instances:
+                yield instance
+
+        next_token = getattr(reservations, 'nextToken', None)
+        if not next_token:
+            break
+        params['NextToken'] = next_token
 
 def instance_to_node(instance):
     node = {}
     node['id'] = instance.id
-    node['name'] = re.sub('^%s' % env.name_prefix, '', instance.tags.get('Name', ''))
+    node['name'] = re.sub('^%s' % re.escape(env.name_prefix), '', instance.tags.get('Name', ''))
     node['size'] = instance.instance_type
     node['security_group'] = instance.groups[0].name
     node['placement'] = instance.placement
+    node['region'] = instance.region.name
     node['image'] = instance.image_id
     node['state'] = instance.state
     node['running'] = instance.state == 'running'
@@ -342,28 +669,156 @@ def equivalent_create_options(options1, options2):
     options1['image'] = _unalias_image(options1['image'])
     options2['image'] = _unalias_image(options2['image'])
 
-    return (options1['size'] == options2['size']
-            and options1['placement'] == options2['placement']
+    return (_equivalent_choice(options1['size'], options2['size'])
+            and _equivalent_choice(options1['placement'], options2['placement'])
             and options1['security_group'] == options2['security_group']
             and options1['image'] == options2['image'])
 
-def _ec2():
-    if not hasattr(_ec2, 'client'):
-        _ec2.client = boto.ec2.connection.EC2Connection(ACCESS_KEY_ID, SECRET_ACCESS_KEY)
-    return _ec2.client
+def _equivalent_choice(option1, option2):
+    # a node created from a list of sizes or zones has one of them
+    return (option1 == option2
+            or bool(set(_split_options(option1)) & set(_split_options(option2))))
+
+def _ec2(region=None):
+    return _connection(_ec2, region)
+
+def _ec2_paginated(region=None):
+    # boto's default API version doesn't paginate DescribeInstances
+    return _connection(_ec2_paginated, region, api_version=PAGINATED_API_VERSION)
+
+def _connection(memo, region, **kwargs):
+    # one connection per region, kept in memo.clients
+    region = region or DEFAULT_REGION
+    if not hasattr(memo, 'clients'):
+        memo.clients = {}
+    if region not in memo.clients:
+        memo.clients[region] = boto_ec2.connection.EC2Connection(
+            ACCESS_KEY_ID, SECRET_ACCESS_KEY,
+            region=boto_ec2.RegionInfo(name=region, endpoint='ec2.%s.amazonaws.com' % region),
+            **kwargs)
+    return memo.clients[region]
+
+def _instance_states(instance_ids, region=None):
+    '''
+    Return a dict of instance ID to state name, for all instance_ids
+    in a single DescribeInstanceStatus call. Instances EC2 doesn't know
+    about yet are left out.
+    '''
+    connection = _ec2_paginated(region)
+    params = {'IncludeAllInstances': 'true'}
+    connection.build_list_params(params, instance_ids, 'InstanceId')
+    try:
+        statuses = connection.get_list(
+            'DescribeInstanceStatus', params,
+            [('item', boto_ec2.instancestatus.InstanceStatus)], verb='POST')
+    except connection.ResponseError, e:
+        if e.error_code == 'InvalidInstanceID.NotFound':
+            return {}
+        raise
+    return {s.id: s.state_name for s in statuses}
+
+def _zone_region(zone):
+    # us-east-1b -> us-east-1
+    if zone:
+        return re.sub('[a-z]$', '', zone)
+
+def _split_options(value):
+    # size and placement can be lists, or strings separated by semicolons
+    if value is None:
+        return []
+    if isinstance(value, basestring):
+        return [v.strip() for v in value.split(';') if v.strip()]
+    return list(value)
+
+def _spot_candidates(sizes, zones, bid):
+    '''
+    Return (price, size, zone) of the combinations of sizes and zones
+    whose current spot price is at most bid, cheapest first.
+    '''
+    stats = spot_price_stats(dict(zip(zones, util.parallel_map(spot_price_history, zones))))
+    return sorted((stats[(zone, size)]['recent'], size, zone)
+                  for size in sizes for zone in zones
+                  if (zone, size) in stats and stats[(zone, size)]['recent'] <= bid)
+
+def _on_demand_fallback(sizes, zones, candidates):
+    # the cheapest size on demand, in the zone with the cheapest spot
+    # price if there was one
+    node_types = get_node_types()
+    def cost(size):
+        # sizes without a price go last, smallest first
+        node_type = node_types.get(size, {})
+        return (node_type.get('linux_cost') or float('inf'),
+                node_type.get('memory') or float('inf'))
+    size = min(sizes, key=cost)
+    if candidates:
+        return size, candidates[0][2]
+    return size, zones[0]
+
+def _spot_requests_by_id(spot_requests):
+    # spot_requests is a dict of request ID -> (rank, region)
+    ids = collections.OrderedDict()
+    for request_id, (_, region) in spot_requests.items():
+        ids.setdefault(region, []).append(request_id)
+
+    def describe(region):
+        return _ec2(region).get_all_spot_instance_requests(ids[region])
+    return sum(util.parallel_map(describe, ids), [])
+
+def _cancel_spot_requests(request_ids, spot_requests):
+    '''
+    Cancel the spot requests, and terminate any instances they've
+    started, including ones started since they were last looked at.
+    '''
+    losers = {r: spot_requests[r] for r in request_ids}
+    for region, ids in _ids_by_region([{'region': region, 'id': r}
+                                       for r, (_, region) in losers.items()]).items():
+        _ec2(region).cancel_spot_instance_requests(ids)
+
+    started = [{'region': losers[r.id][1], 'id': r.instance_id}
+               for r in _spot_requests_by_id(losers) if r.instance_id]
+    for region, ids in _ids_by_region(started).items():
+        print 'Terminating surplus spot instances %s' % ', '.join(ids)
+        _ec2(region).terminate_instances(ids)
+
+def _ids_by_region(nodes):
+    # instance IDs grouped by region, since each call goes to one region
+    ids = collections.OrderedDict()
+    for node in nodes:
+        ids.setdefault(node['region'], []).append(node['id'])
+    return ids
 
 def _host_node():
-    return [x for x in all_nodes() if x['ip'] == env.host][0]
+    return headintheclouds.host_node(all_nodes)
 
 def _host_role():
     return _host_node()['role']
 
-def _set_instance_name(instance_id, name):
-    _ec2().create_tags(instance_id, {'Name': '%s%s' % (env.name_prefix, name)})
+def _set_instance_name(instance_id, name, region=None):
+    _set_instance_names([instance_id], [name], region)
+
+def _set_instance_names(instance_ids, names, region=None):
+    # CreateTags sets the same tags on any number of instances, so
+    # there's one call per distinct name
+    ids_by_name = collections.OrderedDict()
+    for instance_id, name in zip(instance_ids, names):
+        ids_by_name.setdefault(name, []).append(instance_id)
+    for name, ids in ids_by_name.items():
+        _ec2(region).create_tags(ids, {'Name': '%s%s' % (env.name_prefix, name)})
+
+def _nodes_by_id(instance_ids, region=None):
+    '''
+    Look up the nodes of instance_ids in a single DescribeInstances
+    call, whatever their state and name.
+    '''
+    reservations = _ec2_paginated(region).get_all_instances(instance_ids)
+    return [instance_to_node(x) for r in reservations for x in r.instances]
 
 def _unalias_image(image):
     return IMAGE_ALIASES.get(image.lower(), image)
 
+# the AMIs of IMAGE_ALIASES, which only exist in this region
+IMAGE_ALIAS_REGION = 'us-east-1'
+
 IMAGE_ALIASES = {
     'ubuntu 12.04':      'ami-ad3660c4',
     'ubuntu 12.04 ebs':  'ami-a73264ce',
@@ -382,6 +837,34 @@ IMAGE_ALIASES = {
     'ubuntu 14.04 hvm':  'ami-b6f710de',
 }
 
+# instance states that all_nodes() returns
+LIVE_STATES = ['pending', 'running', 'stopping', 'stopped']
+
+# DescribeInstances supports MaxResults and NextToken from this API
+# version, and returns at most 1000 instances per page
+PAGINATED_API_VERSION = '2014-10-01'
+PAGE_SIZE = 1000
+
+# days of spot price history that pricing() shows statistics for
+SPOT_HISTORY_DAYS = 1
+
+# with several sizes or placements, spot instances are requested in this
+# many of the cheapest combinations at once. instances that haven't
+# started after SPOT_DEADLINE seconds are created on demand instead
+SPOT_CANDIDATES = 3
+SPOT_DEADLINE = int(os.environ.get('AWS_SPOT_DEADLINE', 10 * 60))
+
+# the on-demand pricing catalog, kept in NODE_TYPES_FILENAME and
+# refreshed after NODE_TYPES_TTL seconds. NODE_TYPES_SNAPSHOT is used
+# until the first refresh, and when the file is from another version
+NODE_TYPES_URL = 'http://aws-assets-pricing-prod.s3.amazonaws.com/pricing/ec2/linux-od.js'
+NODE_TYPES_FILENAME = '~/.hitc/ec2_node_types.json'
+NODE_TYPES_SNAPSHOT = os.path.join(os.path.dirname(__file__), 'ec2_node_types.json')
+NODE_TYPES_TTL = 24 * 60 * 60
+NODE_TYPES_TIMEOUT = 5
+NODE_TYPES_VERSION = 1
+NODE_TYPE_COLUMNS = ['linux_cost', 'memory', 'storage', 'cores', 'compute_units', 'gpu']
+
 ACCESS_KEY_ID = util.env_var('AWS_ACCESS_KEY_ID')
 SECRET_ACCESS_KEY = util.env_var('AWS_SECRET_ACCESS_KEY')
 SSH_KEY_FILENAME = util.env_var('AWS_SSH_KEY_FILENAME')
@@ -27,6 +27,7 @@ def create_things(servers, dependency_graph, changing_servers, changing_containe
 
     queue = multiprocessing.Queue()
     processes = make_processes(servers, queue, things_to_change)
+    batches = batch_servers(processes, dependency_graph, thing_index)
     n_completed = 0
 
     # don't do this for now
@@ -39,7 +40,11 @@ def create_things(servers, dependency_graph, changing_servers, changing_containe
         remaining -= free_nodes
         
         for thing_name in free_nodes:
-            processes[thing_name].thing = thing_index[thing_name]
+            if thing_name in batches:
+                processes[thing_name].thing = ServerBatch(
+                    [thing_index[n] for n in batches[thing_name]])
+            else:
+                processes[thing_name].thing = thing_index[thing_name]
             processes[thing_name].start()
 
             if not free_nodes:
@@ -95,6 +100,87 @@ def make_processes(servers, queue, things_to_delete):
 
     return processes
 
+def batch_servers(processes, dependency_graph, thing_index):
+    '''
+    Group new servers that have the same create options and don't
+    depend on anything, so that each group is created with a single
+    create_servers call. Only the first server of each group keeps its
+    process. Returns a dict of the first server's thing name to the
+    thing names of all servers in its group.
+    '''
+    groups = []
+    for thing_name in sorted(dependency_graph.get_free_nodes(set(processes))):
+        thing_type, _ = thing_name
+        if thing_type != 'SERVER' or processes[thing_name].thing_to_delete:
+            continue
+
+        server = thing_index[thing_name]
+        for group in groups:
+            first = thing_index[group[0]]
+            # not has_equivalent_options(), which ignores options
+            # like the spot bid that don't matter once it's running
+            if (first.is_equivalent_provider(server)[0]
+                and first.get_create_options() == server.get_create_options()):
+                group.append(thing_name)
+                break
+        else:
+            groups.append([thing_name])
+
+    batches = {}
+    for group in groups:
+        if len(group) > 1:
+            batches[group[0]] = group
+            for thing_name in group[1:]:
+                del processes[thing_name]
+    return batches
+
+class ServerBatch(object):
+    '''
+    Servers with the same create options, created together.
+    '''
+
+    def __init__(self, servers):
+        self.servers = servers
+
+    def pre_create(self):
+        for server in self.servers:
+            server.pre_create()
+
+    def create(self):
+        first = self.servers[0]
+        nodes = first.server_provider().create_servers(
+            names=[s.name for s in self.servers], count=len(self.servers),
+            **first.get_create_options())
+
+        nodes_by_name = {n['name']: n for n in nodes}
+        for server in self.servers:
+            server.update(nodes_by_name[server.name])
+
+        # set the servers up at the same time, like they would have
+        # been if they were created one by one
+        if MULTI_THREADED:
+            processes = [multiprocessing.Process(target=post_create, args=(s,))
+                         for s in self.servers]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            failed = [s.name for s, p in zip(self.servers, processes) if p.exitcode != 0]
+            if failed:
+                raise exceptions.RuntimeException('Failed to set up %s' % ', '.join(failed))
+        else:
+            for server in self.servers:
+                server.post_create()
+
+        return self.servers
+
+    def __repr__(self):
+        return '<ServerBatch: %s>' % ', '.join(s.name for s in self.servers)
+
+def post_create(server):
+    fabric.network.disconnect_all()
+    server.post_create()
+
 class UpProcess(multiprocessing.Process):
 
     def __init__(self, thing_name, queue, thing_to_delete=None):
@@ -1,17 +1,18 @@
 import sys
 import os
-import yaml
 
 from fabric.api import * # pylint: disable=W0614,W0401
 
-from headintheclouds.tasks import uncache
+from headintheclouds import util
+from headintheclouds.tasks import uncache, localtask
 from headintheclouds.ensemble import parse
 from headintheclouds.ensemble import dependency
 from headintheclouds.ensemble import create
 from headintheclouds.ensemble import exceptions
 
-@runs_once
-@task
+yaml = util.lazy_import('yaml')
+
+@localtask
 def up(name, debug=False):
     '''
     Create servers and containers as required to meet the configuration
@@ -5,10 +5,10 @@ import random
 import time
 from collections import Counter
 import sys
+import types
+import threading
 import dateutil
 import re
-from oauth2client.client import GoogleCredentials
-from googleapiclient import discovery
 
 from fabric.api import * # pylint: disable=W0614,W0401
 import fabric.api as fab
@@ -17,6 +17,11 @@ import headintheclouds
 from headintheclouds import util, cache
 from headintheclouds.tasks import cloudtask
 
+requests = util.lazy_import('requests')
+googleapiclient = util.lazy_import('googleapiclient')
+discovery = util.lazy_import('googleapiclient.discovery')
+oauth_client = util.lazy_import('oauth2client.client')
+
 __all__ = ['terminate_and_create_image']
 
 @cloudtask
@@ -28,7 +33,7 @@ def terminate_and_create_image(name):
         name: The name of the image
     '''
     node = _host_node()
-    operation = _gcp().instances().delete(project=DEFAULT_PROJECT, zone=DEFAULT_ZONE,
+    operation = _gcp().instances().delete(project=_default_project(), zone=_default_zone(),
                                           instance=node['real_name']).execute()
     while True:
         status = get_zone_operation_status(operation=operation)
@@ -43,7 +48,7 @@ def terminate_and_create_image(name):
         'sourceDisk': node['source_disk'],
     }
 
-    operation = _gcp().images().insert(project=DEFAULT_PROJECT, body=body).execute()
+    operation = _gcp().images().insert(project=_default_project(), body=body).execute()
     while True:
         status = get_global_operation_status(operation=operation)
         if status == 'DONE':
@@ -55,7 +60,7 @@ def terminate_and_create_image(name):
     print 'Created image: %s' % operation['targetLink']
 
 def pricing(sort):
-    types = _gcp().machineTypes().list(project=DEFAULT_PROJECT, zone=DEFAULT_ZONE).execute()['items']
+    types = _gcp().machineTypes().list(project=_default_project(), zone=_default_zone()).execute()['items']
 
     def gpu_regex(m, g):
         match = re.search(r'^[0-9]+ vCPUs?, [0-9]+ GB RAM, and (?P<gpu_cores>[0-9]+) dies? of (?P<gpu_type>.+) with (?P<gpu_ram>.+) of RAM', m['description'])
@@ -74,12 +79,15 @@ def pricing(sort):
     util.print_table(table, ['name', 'cpu_cores', 'ram', 'gpu_type', 'gpu_cores', 'gpu_ram'], sort='cpu_cores')
 
 def nodes():
-    util.print_table(cache.recache(all_nodes),
+    util.print_table(all_nodes(),
                      ['name', 'type', 'ip', 'internal_ip', 'status', 'created'], sort='name')
 
-@cache.cached
+def _cache_namespace():
+    return ['gcp', _default_project(), _default_zone(), env.name_prefix]
+
+@cache.cached(ttl=60, stale_ttl=None, namespace=_cache_namespace)
 def all_nodes():
-    instances = _gcp().instances().list(project=DEFAULT_PROJECT, zone=DEFAULT_ZONE).execute().get('items', [])
+    instances = _gcp().instances().list(project=_default_project(), zone=_default_zone()).execute().get('items', [])
     nodes = [instance_to_node(instance)
              for instance in instances
              if instance['name'].startswith(env.name_prefix)
@@ -99,12 +107,13 @@ def create_servers(count, names, type, image, network,
         print 'Creating GCP %s instance' % type
 
     names = [name or random_name() for name in names]
+    network = network or _default_network()
 
     operations = []
     for i, name in enumerate(names):
         body = {
             'name': name_with_prefix(name),
-            'machineType': 'zones/%s/machineTypes/%s' % (DEFAULT_ZONE, type),
+            'machineType': 'zones/%s/machineTypes/%s' % (_default_zone(), type),
             'disks': [
                 {
                     'boot': True,
@@ -130,7 +139,7 @@ def create_servers(count, names, type, image, network,
                 'onHostMaintenance': on_host_maintenance,
             }
         }
-        operation = _gcp().instances().insert(project=DEFAULT_PROJECT, zone=DEFAULT_ZONE, body=body).execute()
+        operation = _gcp().instances().insert(project=_default_project(), zone=_default_zone(), body=body).execute()
         operations.append(operation)
 
     while True:
@@ -153,18 +162,18 @@ def create_servers(count, names, type, image, network,
 
     for name in names:
         local('gcloud compute --project "%s" ssh --zone "%s" "%s" -- exit' %
-              (DEFAULT_PROJECT, DEFAULT_ZONE, name_with_prefix(name)))
+              (_default_project(), _default_zone(), name_with_prefix(name)))
 
     nodes = [n for n in all_nodes() if n['name'] in names]
     return nodes
 
 def get_zone_operation_status(operation):
     return _gcp().zoneOperations().get(
-        project=DEFAULT_PROJECT, zone=DEFAULT_ZONE, operation=operation['name']).execute()['status']
+        project=_default_project(), zone=_default_zone(), operation=operation['name']).execute()['status']
 
 def get_global_operation_status(operation):
     return _gcp().globalOperations().get(
-        project=DEFAULT_PROJECT, operation=operation['name']).execute()['status']
+        project=_default_project(), operation=operation['name']).execute()['status']
 
 def wait_for_instances_to_become_accessible(names):
     while True:
@@ -195,10 +204,30 @@ def validate_create_options(type, image, network,
     return {}
 
 def terminate():
-    print 'Terminating GCP instance %s' % _host_node()['real_name']
-    _gcp().instances().delete(
-        project=DEFAULT_PROJECT, zone=DEFAULT_ZONE,
-        instance=_host_node()['real_name']).execute()
+    terminate_nodes([_host_node()])
+
+# most calls the API accepts in one batch request
+BATCH_SIZE = 1000
+
+def terminate_nodes(nodes):
+    names = [n['real_name'] for n in nodes]
+    print 'Terminating GCP instances %s' % ', '.join(names)
+
+    errors = []
+    def callback(request_id, response, exception):
+        if exception is not None:
+            errors.append(exception)
+
+    # one HTTP request per BATCH_SIZE instances rather than one each
+    for i in range(0, len(names), BATCH_SIZE):
+        batch = _gcp().new_batch_http_request(callback=callback)
+        for name in names[i:i + BATCH_SIZE]:
+            batch.add(_gcp().instances().delete(
+                project=_default_project(), zone=_default_zone(), instance=name))
+        batch.execute()
+    if errors:
+        raise errors[0]
+
     time.sleep(1)
     cache.uncache(all_nodes)
 
@@ -226,7 +255,7 @@ def instance_to_node(instance):
 def instance_get_boot_disk(instance):
     boot_disk = [d for d in instance['disks'] if d['boot']][0]
     disk_name = boot_disk['source'].split('/')[-1]
-    disk = _gcp().disks().get(project=DEFAULT_PROJECT, zone=DEFAULT_ZONE, disk=disk_name).execute()
+    disk = _gcp().disks().get(project=_default_project(), zone=_default_zone(), disk=disk_name).execute()
     boot_disk.update(disk)
     return boot_disk
 
@@ -242,6 +271,8 @@ def random_name():
 def equivalent_create_options(options1, options2):
     options1 = options1.copy()
     options2 = options2.copy()
+    for options in options1, options2:
+        options['network'] = options['network'] or _default_network()
 
     return (
         options1['image'] == options2['image']
@@ -253,13 +284,31 @@ def equivalent_create_options(options1, options2):
     )
 
 def _host_node():
-    return [x for x in all_nodes() if x['ip'] == env.host][0]
+    return headintheclouds.host_node(all_nodes)
+
+_gcp_local = threading.local()
 
 def _gcp():
-    if not hasattr(_gcp, 'client'):
-        credentials = GoogleCredentials.get_application_default()
-        _gcp.client = discovery.build('compute', 'v1', credentials=credentials)
-    return _gcp.client
+    # httplib2 isn't thread safe, and all_nodes can be refreshed in a
+    # background thread, so each thread gets its own client
+    if not hasattr(_gcp_local, 'client'):
+        credentials = oauth_client.GoogleCredentials.get_application_default()
+        _gcp_local.client = discovery.build_from_document(
+            _discovery_document('compute', 'v1'), credentials=credentials)
+    return _gcp_local.client
+
+def _discovery_namespace():
+    return ['gcp', googleapiclient.__version__]
+
+@cache.cached(ttl=7*24*60*60, stale_ttl=None, namespace=_discovery_namespace)
+def _discovery_document(api, version):
+    # discovery.build() fetches and parses this large document every
+    # time a client is created, so it's cached per api version and
+    # client library version
+    url = discovery.DISCOVERY_URI.format(api=api, apiVersion=version)
+    response = requests.get(url, timeout=DISCOVERY_TIMEOUT)
+    response.raise_for_status()
+    return response.text
 
 def read_gcloud_config():
     filename = os.path.join(os.path.expanduser('~'), '.config', 'gcloud', 'configurations', 'config_default')
@@ -267,15 +316,35 @@ def read_gcloud_config():
     config.read(filename)
     return config
 
-GCLOUD_CONFIG = read_gcloud_config()
-DEFAULT_PROJECT = GCLOUD_CONFIG.get('core', 'project')
-DEFAULT_ZONE = GCLOUD_CONFIG.get('compute', 'zone')
+def _gcloud_config():
+    if not hasattr(_gcloud_config, 'config'):
+        _gcloud_config.config = read_gcloud_config()
+    return _gcloud_config.config
+
+def _default_project():
+    if not hasattr(_default_project, 'project'):
+        _default_project.project = _gcloud_config().get('core', 'project')
+    return _default_project.project
+
+def _default_zone():
+    if not hasattr(_default_zone, 'zone'):
+        _default_zone.zone = _gcloud_config().get('compute', 'zone')
+    return _default_zone.zone
+
+def _default_network():
+    return 'https://www.googleapis.com/compute/v1/projects/%s/global/networks/default' % _default_project()
+
+# the discovery document is fetched in background refreshes, which
+# fab waits for before exiting
+DISCOVERY_TIMEOUT = 30
+
 SSH_KEY_FILENAME = util.env_var('GCP_SSH_KEY_FILENAME', os.path.join(os.path.expanduser('~'), '.ssh', 'google_compute_engine'))
 
 create_server_defaults = {
     'image': None,
     'type': None,
-    'network': 'https://www.googleapis.com/compute/v1/projects/%s/global/networks/default' % DEFAULT_PROJECT,
+    # None means the default network of the gcloud project
+    'network': None,
     'auto_delete_boot_disk': True,
     'on_host_maintenance': 'MIGRATE',
     'boot_disk_size_gb': 20
@@ -286,4 +355,48 @@ settings = {
     'key_filename': SSH_KEY_FILENAME,
 }
 
+class _GCPModule(types.ModuleType):
+    '''
+    Stand-in for this module, where GCLOUD_CONFIG, DEFAULT_PROJECT and
+    DEFAULT_ZONE are read from the gcloud config when they're first
+    used rather than on import. Setting DEFAULT_PROJECT or DEFAULT_ZONE
+    overrides the config.
+    '''
+
+    def __init__(self, module):
+        super(_GCPModule, self).__init__(module.__name__, module.__doc__)
+        # fab finds tasks in the module's __dict__
+        self.__dict__.update(module.__dict__)
+        # python 2 clears the globals of a module that's garbage
+        # collected, so the real module is kept
+        self.__dict__['_module'] = module
+
+    def __setattr__(self, attr, value):
+        super(_GCPModule, self).__setattr__(attr, value)
+        if not isinstance(getattr(type(self), attr, None), property):
+            # the module's functions use its globals
+            setattr(self._module, attr, value)
+
+    @property
+    def GCLOUD_CONFIG(self):
+        return _gcloud_config()
+
+    @property
+    def DEFAULT_PROJECT(self):
+        return _default_project()
+
+    @DEFAULT_PROJECT.setter
+    def DEFAULT_PROJECT(self, project):
+        _default_project.project = project
+
+    @property
+    def DEFAULT_ZONE(self):
+        return _default_zone()
+
+    @DEFAULT_ZONE.setter
+    def DEFAULT_ZONE(self, zone):
+        _default_zone.zone = zone
+
+sys.modules[__name__] = _GCPModule(sys.modules[__name__])
+
 headintheclouds.add_provider('gcp', sys.modules[__name__])
@@ -4,10 +4,13 @@ import time
 from StringIO import StringIO
 from functools import wraps
 from fabric.api import * # pylint: disable=W0614,W0401
-import envtpl
+from fabric.tasks import WrappedCallableTask
 
-from headintheclouds import provider_settings, provider_by_name, this_provider
+from headintheclouds import provider_settings, provider_by_name, this_provider, provider_nodes, hosts_by_provider
 from headintheclouds import cache
+from headintheclouds import util
+
+envtpl = util.lazy_import('envtpl')
 
 def cloudtask(func):
     @wraps(func)
@@ -16,19 +19,37 @@ def cloudtask(func):
             func(*args, **kwargs)
     return task(wrapper)
 
-@task
-@runs_once
+class HostlessTask(WrappedCallableTask):
+    '''
+    A task that doesn't run on the nodes. Unless hosts or roles are given
+    for the task on the command line, it runs once locally, and looking
+    up its hosts doesn't trigger node discovery.
+    '''
+
+    def get_hosts_and_effective_roles(self, arg_hosts, arg_roles, arg_exclude_hosts, env=None):
+        if arg_hosts or arg_roles:
+            return super(HostlessTask, self).get_hosts_and_effective_roles(
+                arg_hosts, arg_roles, arg_exclude_hosts, env)
+        return [], []
+
+def localtask(func):
+    return task(task_class=HostlessTask)(runs_once(func))
+
+@localtask
 def nodes():
     '''
     List running nodes on all enabled cloud providers. Automatically flushes caches
     '''
+    # refresh all providers' node lists at the same time, nodes() then
+    # prints them from the cache
+    listed = provider_nodes(env.providers, refresh=True, ignore_errors=True)
     for name, provider in env.providers.items():
-        print name
-        provider.nodes()
-        print
+        if name in listed:
+            print name
+            provider.nodes()
+            print
 
-@task
-@runs_once
+@localtask
 def create(provider, count=1, name=None, **kwargs):
     r'''
     Create one or more cloud servers
@@ -66,6 +87,39 @@ def reboot():
     '''
     this_provider().reboot()
 
+@task
+@serial
+@runs_once
+def terminate_batch(immediately=False):
+    '''
+    Terminate server(s) with one API call per provider and region
+    '''
+    nodes_by_provider = hosts_by_provider(env.all_hosts)
+    if not immediately:
+        print 'Sleeping for ten seconds so you can change your mind if you want to!!!'
+        time.sleep(10)
+    for provider, nodes in nodes_by_provider.items():
+        _batch(provider, 'terminate', nodes)
+
+@task
+@serial
+@runs_once
+def reboot_batch():
+    '''
+    Reboot server(s) with one API call per provider and region
+    '''
+    for provider, nodes in hosts_by_provider(env.all_hosts).items():
+        _batch(provider, 'reboot', nodes)
+
+def _batch(provider, action, nodes):
+    # providers without a bulk call do one node at a time
+    if hasattr(provider, '%s_nodes' % action):
+        getattr(provider, '%s_nodes' % action)(nodes)
+    else:
+        for node in nodes:
+            with settings(host=node['ip'], host_string=node['ip']):
+                getattr(provider, action)()
+
 @cloudtask
 @parallel
 def rename(new_name):
@@ -77,14 +131,39 @@ def rename(new_name):
     '''
     this_provider().rename(new_name)
 
-@task
-@runs_once
+@localtask
 def uncache():
     '''
     Flush the cache
     '''
     cache.flush()
 
+@localtask
+def cache_stats(n=10):
+    '''
+    Print cache size, hit rate and the biggest entries
+
+    Args:
+        n (int) =10: Number of entries to list
+    '''
+    stats = cache.stats()
+    if stats is None:
+        print 'Caching is disabled'
+        return
+
+    lookups = stats.get('memory_hits', 0) + stats.get('disk_hits', 0) + stats.get('misses', 0)
+    hits = lookups - stats.get('misses', 0)
+    print 'Entries:  %d' % stats['entries']
+    print 'Size:     %d bytes (%d bytes on disk)' % (stats['bytes'], stats['file_bytes'])
+    print 'Hit rate: %.1f%% of %d lookups' % (100.0 * hits / (lookups or 1), lookups)
+    print
+
+    entries = cache.biggest(int(n))
+    for entry in entries:
+        entry['key'] = repr(entry['key'])[1:-1][:80]
+    if entries:
+        util.print_table(entries, ['key', 'size'])
+
 @cloudtask
 def ssh(cmd=''):
     '''
@@ -122,11 +201,14 @@ def rsync_down(remote_path, local_path):
 def download(remote_path, local_path):
     get(remote_path, local_path)    
 
-@task
-@runs_once
+@localtask
 def pricing(sort='cost', **kwargs):
-    '''
+    r'''
     Print pricing tables for all enabled providers
+
+    Args:
+        * sort (str) ='cost': Column to sort by
+        * \**kwargs: Provider-specific flags, e.g. zones="us-east-1a;us-east-1b" for EC2 spot prices in several zones
     '''
     for name, provider in env.providers.items():
         print name
@@ -1,10 +1,19 @@
 import os
 import re
+import sys
+import time
+import errno
+import random
+import select
+import socket
+import threading
 import math
 import uuid
 import contextlib
 from functools import wraps
 import inspect
+import types
+import importlib
 from fabric.api import *
 
 def print_table(table, columns=None, sort=None, default_sort=None):
@@ -39,7 +48,8 @@ def print_table(table, columns=None, sort=None, default_sort=None):
                 return x[column]
             except (KeyError, TypeError):
                 return getattr(x, column, None)
-        table.sort(key=sort_key)
+        # table may be a cached list shared with other callers
+        table = sorted(table, key=sort_key)
 
     column_names = []
     for column in columns:
@@ -93,6 +103,96 @@ def env_var(var, default=None):
         raise Exception('Missing required environment variable: %s' % var)
     return value
 
+class LazyModule(types.ModuleType):
+    '''
+    Stand-in for a module that is imported the first time one of its
+    attributes is used.
+    '''
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self.__name__), attr)
+
+def lazy_import(name):
+    '''
+    Return the module called name, to be imported when it's first used,
+    so that SDKs are only loaded by the providers that are used.
+    '''
+    return LazyModule(name)
+
+def parallel_map(func, items):
+    '''
+    Like map(), but calls func on all items at the same time, each in
+    its own thread. If any call raises, the first error (in the order
+    of items) is raised once all calls are done.
+    '''
+    items = list(items)
+    results = [None] * len(items)
+    errors = [None] * len(items)
+
+    def call(i, item):
+        try:
+            results[i] = func(item)
+        except BaseException:
+            errors[i] = sys.exc_info()
+
+    threads = [threading.Thread(target=call, args=(i, item))
+               for i, item in enumerate(items)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for error in errors:
+        if error:
+            raise error[0], error[1], error[2]
+    return results
+
+def backoff(initial=1, maximum=15, factor=1.5, jitter=0.5):
+    '''
+    Yield delays for polling, starting at initial seconds and growing
+    by factor up to maximum. Each delay is randomly shortened by up to
+    jitter (as a fraction) so that concurrent pollers spread out.
+    '''
+    delay = initial
+    while True:
+        yield delay * (1 - jitter * random.random())
+        delay = min(delay * factor, maximum)
+
+def reachable(hosts, port=22, timeout=5):
+    '''
+    Return the set of hosts that accept TCP connections on port. All
+    hosts are tried at the same time, and the ones that haven't
+    answered after timeout seconds are left out.
+    '''
+    result = set()
+    pending = {}
+    for host in hosts:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        error = sock.connect_ex((host, port))
+        if error in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            pending[sock] = host
+            continue
+        if error == 0:
+            result.add(host)
+        sock.close()
+
+    deadline = time.time() + timeout
+    while pending:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        _, connected, _ = select.select([], list(pending), [], remaining)
+        for sock in connected:
+            host = pending.pop(sock)
+            if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                result.add(host)
+            sock.close()
+
+    for sock in pending:
+        sock.close()
+    return result
+
 def average(x):
     return sum(x) * 1.0 / len(x)
 
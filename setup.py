@@ -10,6 +10,7 @@ setup(name='headintheclouds',
                 'headintheclouds.ensemble',
                 'headintheclouds.dependencies',
                 'headintheclouds.dependencies.PyDbLite'],
+      package_data={'headintheclouds': ['ec2_node_types.json']},
       url='https://github.com/andreasjansson/head-in-the-clouds',
       install_requires=[
           'Fabric>=1.6.1',
@@ -18,5 +19,6 @@ setup(name='headintheclouds',
           'python-dateutil==2.1',
           'simplejson',
           'envtpl==0.3.2',
+          'numpy',
       ],
   )
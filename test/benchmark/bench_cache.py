@@ -0,0 +1,48 @@
+'''
+Measure cache.set/cache.get latency as the cache grows.
+
+Usage:
+    python test/benchmark/bench_cache.py [max_entries]
+'''
+
+import sys
+import time
+import uuid
+
+from headintheclouds import cache
+
+def bench(max_entries=10000, step=1000, samples=100):
+    cache.FILENAME = 'tmp_bench_cache.db'
+    # don't evict before the cache reaches max_entries
+    cache.MAX_ENTRIES = max_entries + step
+    cache.MAX_BYTES = sys.maxint
+    cache.flush()
+
+    value = {'nodes': [{'ip': '10.0.0.%d' % i, 'name': 'node-%d' % i}
+                       for i in range(20)]}
+
+    print '%8s  %12s  %12s' % ('entries', 'set (ms)', 'get (ms)')
+    try:
+        while cache.size() < max_entries:
+            for _ in range(step - samples):
+                cache.set(str(uuid.uuid4()), value)
+
+            keys = [str(uuid.uuid4()) for _ in range(samples)]
+            start = time.time()
+            for key in keys:
+                cache.set(key, value)
+            set_ms = (time.time() - start) * 1000.0 / samples
+
+            # time reads from the database, not the in-memory LRU
+            cache._memory.clear()
+            start = time.time()
+            for key in keys:
+                cache.get(key)
+            get_ms = (time.time() - start) * 1000.0 / samples
+
+            print '%8d  %12.3f  %12.3f' % (cache.size(), set_ms, get_ms)
+    finally:
+        cache.flush()
+
+if __name__ == '__main__':
+    bench(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,46 @@
+'''
+Measure node discovery time with fake providers of different latencies,
+listing them one after another and all at the same time.
+
+Usage:
+    python test/benchmark/bench_discovery.py [latency_1 latency_2 ...]
+'''
+
+import sys
+import time
+import types
+
+import headintheclouds
+
+class FakeProvider(types.ModuleType):
+
+    def __init__(self, name, latency, count=100):
+        super(FakeProvider, self).__init__(name)
+        self.latency = latency
+        self.count = count
+
+    def all_nodes(self):
+        time.sleep(self.latency)
+        return [{'name': '%s-%d' % (self.__name__, i), 'ip': '10.0.0.%d' % i}
+                for i in range(self.count)]
+
+def serial(providers):
+    return {name: module.all_nodes() for name, module in providers.items()}
+
+def concurrent(providers):
+    return headintheclouds.provider_nodes(providers)
+
+def bench(latencies):
+    providers = {'fake%d' % i: FakeProvider('fake%d' % i, latency)
+                 for i, latency in enumerate(latencies)}
+
+    print 'latencies (s): %s' % ', '.join('%.2f' % l for l in latencies)
+    print '%12s  %10s' % ('', 'time (s)')
+    for fn in [serial, concurrent]:
+        start = time.time()
+        fn(providers)
+        print '%12s  %10.3f' % (fn.__name__, time.time() - start)
+
+if __name__ == '__main__':
+    latencies = [float(x) for x in sys.argv[1:]] or [0.8, 0.5, 0.3, 0.05]
+    bench(latencies)
@@ -0,0 +1,58 @@
+'''
+Measure the DescribeInstances payload size and the latency of
+ec2.all_nodes() against a fake EC2 endpoint as the number of instances
+in the account grows, fetching everything and filtering locally versus
+filtering on the server.
+
+Usage:
+    python test/benchmark/bench_ec2_all_nodes.py [max_instances]
+'''
+
+import os
+import sys
+import time
+
+for name in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY',
+             'AWS_SSH_KEY_FILENAME', 'AWS_KEYPAIR_NAME']:
+    os.environ.setdefault(name, 'x')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'unit'))
+
+from fabric.api import env
+from headintheclouds import ec2, cache
+from fake_ec2 import FakeEC2, make_instances
+
+def unfiltered(fake):
+    connection = fake.connection()
+    return [ec2.instance_to_node(x)
+            for r in connection.get_all_instances() for x in r.instances
+            if x.tags.get('Name', '').startswith(env.name_prefix)
+            and x.state not in ('terminated', 'shutting-down')]
+
+def filtered(fake):
+    ec2.REGIONS = ['fake']
+    ec2._ec2_paginated.clients = {'fake': fake.connection(ec2.PAGINATED_API_VERSION)}
+    return ec2.all_nodes()
+
+def bench(max_instances=10000):
+    cache.NO_CACHE = True
+
+    print '%10s  %12s  %12s  %10s  %8s  %8s' % (
+        'instances', 'method', 'bytes', 'time (ms)', 'requests', 'nodes')
+    count = 100
+    while count <= max_instances:
+        fake = FakeEC2(make_instances(count))
+        try:
+            for fn in [unfiltered, filtered]:
+                del fake.requests[:]
+                start = time.time()
+                nodes = fn(fake)
+                elapsed = (time.time() - start) * 1000.0
+                print '%10d  %12s  %12d  %10.1f  %8d  %8d' % (
+                    count, fn.__name__, sum(size for _, size in fake.requests),
+                    elapsed, len(fake.requests), len(nodes))
+        finally:
+            fake.close()
+        count *= 10
+
+if __name__ == '__main__':
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,34 @@
+'''
+Measure the time to import headintheclouds.gcp and to create the first
+compute client, with the discovery document cache cold and warm.
+
+Needs the Google API client libraries and application default
+credentials.
+
+Usage:
+    python test/benchmark/bench_gcp_client.py
+'''
+
+import time
+
+start = time.time()
+from headintheclouds import gcp
+from headintheclouds import cache
+import_ms = (time.time() - start) * 1000.0
+
+def first_client_ms():
+    gcp._gcp_local.__dict__.clear()
+    start = time.time()
+    gcp._gcp()
+    return (time.time() - start) * 1000.0
+
+def bench():
+    print '%-24s  %10s' % ('', 'time (ms)')
+    print '%-24s  %10.1f' % ('import', import_ms)
+
+    cache.uncache(gcp._discovery_document, 'compute', 'v1')
+    print '%-24s  %10.1f' % ('first client (cold)', first_client_ms())
+    print '%-24s  %10.1f' % ('first client (warm)', first_client_ms())
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,107 @@
+'''
+Measure how long the fabfile entry point takes to start: the import time
+of each headintheclouds module in a fresh interpreter, and the wall time
+of `fab --list` with a fabfile using stub providers.
+
+Usage:
+    python test/benchmark/bench_import.py [budget_ms]
+
+If budget_ms is given, exits with an error when `fab --list` takes
+longer than that.
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+MODULES = [
+    'fabric.api',
+    'headintheclouds',
+    'headintheclouds.tasks',
+    'headintheclouds.docker',
+    'headintheclouds.ensemble',
+    'headintheclouds.ec2',
+    'headintheclouds.gcp',
+    'headintheclouds.unmanaged',
+]
+
+# heavy dependencies that should only be imported when they're used
+SDKS = ['boto', 'googleapiclient', 'oauth2client', 'requests', 'yaml', 'envtpl']
+
+FABFILE = '''
+import types
+from fabric.api import *
+import headintheclouds
+from headintheclouds import docker, ensemble
+from headintheclouds.tasks import *
+
+class StubProvider(types.ModuleType):
+    def all_nodes(self):
+        return [{'name': 'stub', 'ip': '10.0.0.1'}]
+
+headintheclouds.add_provider('stub', StubProvider('stub'))
+'''
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+def run(code, *args):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    env.setdefault('AWS_ACCESS_KEY_ID', 'x')
+    env.setdefault('AWS_SECRET_ACCESS_KEY', 'x')
+    env.setdefault('AWS_SSH_KEY_FILENAME', 'x')
+    env.setdefault('AWS_KEYPAIR_NAME', 'x')
+    process = subprocess.Popen([sys.executable, '-W', 'ignore', '-c', code] + list(args),
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               env=env, cwd=ROOT)
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        raise Exception(stderr)
+    return stdout
+
+def import_time(module, repeat):
+    code = ('import sys, time; start = time.time(); import %s; '
+            'print time.time() - start; '
+            'print " ".join(m for m in %r if m in sys.modules)') % (module, SDKS)
+    times = []
+    for _ in range(repeat):
+        elapsed, sdks = run(code).splitlines()
+        times.append(float(elapsed))
+    return sorted(times)[repeat / 2] * 1000.0, sdks
+
+def fab_list_time(repeat):
+    directory = tempfile.mkdtemp()
+    try:
+        fabfile = os.path.join(directory, 'fabfile.py')
+        with open(fabfile, 'w') as f:
+            f.write(FABFILE)
+        times = []
+        for _ in range(repeat):
+            start = time.time()
+            run('from fabric.main import main; main()', '-f', fabfile, '--list')
+            times.append(time.time() - start)
+        return sorted(times)[repeat / 2] * 1000.0
+    finally:
+        shutil.rmtree(directory)
+
+def bench(budget_ms=None, repeat=5):
+    print '%-28s  %10s  %s' % ('module', 'time (ms)', 'sdks loaded')
+    for module in MODULES:
+        try:
+            elapsed, sdks = import_time(module, repeat)
+        except Exception, e:
+            print '%-28s  %10s  %s' % (module, '-', str(e).strip().splitlines()[-1])
+            continue
+        print '%-28s  %10.1f  %s' % (module, elapsed, sdks)
+
+    elapsed = fab_list_time(repeat)
+    print
+    print '%-28s  %10.1f' % ('fab --list', elapsed)
+
+    if budget_ms is not None and elapsed > budget_ms:
+        sys.exit('fab --list took %.1fms, over the budget of %.1fms' % (elapsed, budget_ms))
+
+if __name__ == '__main__':
+    bench(float(sys.argv[1]) if len(sys.argv) > 1 else None)
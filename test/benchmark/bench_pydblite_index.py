@@ -0,0 +1,50 @@
+'''
+Compare insert/delete churn on bisect and hash indices in PyDbLite, for a
+unique field and for a field with only a few distinct values.
+
+Usage:
+    python test/benchmark/bench_pydblite_index.py [n_records] [n_churn]
+'''
+
+import os
+import sys
+import time
+import random
+
+from headintheclouds.dependencies.PyDbLite import PyDbLite
+
+FILENAME = 'tmp_bench_pydblite.pdl'
+
+def bench(n_records=100000, n_churn=10000):
+    print '%8s  %-8s  %-7s  %12s  %12s' % (
+        'records', 'field', 'kind', 'insert (us)', 'delete (us)')
+
+    for field, value in (('unique', lambda i: i), ('state', lambda i: i % 5)):
+        for kind in ('bisect', 'hash'):
+            db = PyDbLite.Base(FILENAME)
+            db.create(field, mode='override')
+            db.create_index(field, kind=kind)
+            for i in range(n_records):
+                db.insert(**{field: value(i)})
+
+            # delete random records and insert new ones
+            random.seed(0)
+            deleted = [db[_id] for _id in random.sample(db.records.keys(), n_churn)]
+
+            start = time.time()
+            for record in deleted:
+                db.delete(record)
+            delete_us = (time.time() - start) * 1e6 / n_churn
+
+            start = time.time()
+            for record in deleted:
+                db.insert(**{field: record[field]})
+            insert_us = (time.time() - start) * 1e6 / n_churn
+
+            print '%8d  %-8s  %-7s  %12.2f  %12.2f' % (
+                n_records, field, kind, insert_us, delete_us)
+
+    os.unlink(FILENAME)
+
+if __name__ == '__main__':
+    bench(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,49 @@
+'''
+Compare PyDbLite.Base.open() and the first lookup in the classic and the
+lazy layout.
+
+Usage:
+    python test/benchmark/bench_pydblite_open.py [n_records ...]
+'''
+
+import os
+import sys
+import time
+
+from headintheclouds.dependencies.PyDbLite import PyDbLite
+
+FILENAME = 'tmp_bench_pydblite.pdl'
+
+def bench(n_records_list=(1000, 10000, 100000)):
+    print '%8s  %6s  %10s  %14s  %12s' % (
+        'records', 'lazy', 'open (ms)', 'lookup (ms)', 'file (kB)')
+    for n_records in n_records_list:
+        for lazy in (False, True):
+            db = PyDbLite.Base(FILENAME, lazy=lazy)
+            db.create('key', 'value', mode='override')
+            db.create_index('key')
+            for i in range(n_records):
+                value = [{'ip': '10.%d.0.%d' % (i % 256, j), 'name': 'node-%d-%d' % (i, j)}
+                         for j in range(20)]
+                db.insert(key='key-%d' % i, value=value)
+            db.commit()
+
+            start = time.time()
+            db = PyDbLite.Base(FILENAME, lazy=lazy).open()
+            open_ms = (time.time() - start) * 1000
+
+            start = time.time()
+            db._key['key-%d' % (n_records // 2)]
+            lookup_ms = (time.time() - start) * 1000
+
+            print '%8d  %6s  %10.1f  %14.3f  %12d' % (
+                n_records, lazy, open_ms, lookup_ms,
+                os.path.getsize(FILENAME) // 1024)
+
+    os.unlink(FILENAME)
+
+if __name__ == '__main__':
+    if sys.argv[1:]:
+        bench([int(a) for a in sys.argv[1:]])
+    else:
+        bench()
@@ -0,0 +1,79 @@
+'''
+Simulate bringing up a fleet of spot instances against a fake EC2
+endpoint, where the cheapest size and zone takes long to fulfil, and
+compare bidding only in the cheapest placement with bidding in the
+cheapest few at once. Times are simulated seconds, costs are the spot
+price per hour of the kept instances.
+
+Usage:
+    python test/benchmark/bench_spot_placement.py [count]
+'''
+
+import os
+import sys
+import StringIO
+
+for name in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY',
+             'AWS_SSH_KEY_FILENAME', 'AWS_KEYPAIR_NAME']:
+    os.environ.setdefault(name, 'x')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'unit'))
+
+from headintheclouds import ec2, cache, util
+from fake_ec2 import FakeEC2
+
+# (size, zone): (spot price, seconds until spot requests are fulfilled)
+PLACEMENTS = {
+    ('c3.large', 'us-east-1b'): (0.020, 900),
+    ('m1.small', 'us-east-1a'): (0.030, 60),
+    ('c3.large', 'us-east-1a'): (0.040, 120),
+    ('m1.small', 'us-east-1b'): (0.060, 30),
+}
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 24 * 60 * 60
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+def bench(count=100):
+    cache.FILENAME = 'tmp_bench_spot_placement.db'
+    util.reachable = lambda hosts, port: set(hosts)
+    ec2.get_node_types = lambda: {'m1.small': {'linux_cost': 0.044},
+                                  'c3.large': {'linux_cost': 0.105}}
+
+    print '%12s  %10s  %10s  %8s' % ('method', 'time (s)', 'cost ($/h)', 'requests')
+    for method, size, placement in [('cheapest', 'c3.large', 'us-east-1b'),
+                                    ('candidates', 'm1.small;c3.large',
+                                     'us-east-1a;us-east-1b')]:
+        ec2.time = clock = Clock()
+        prices = [{'zone': zone, 'type': s, 'price': price,
+                   'timestamp': ec2._timestamp(clock.now - 60)}
+                  for (s, zone), (price, _) in PLACEMENTS.items()]
+        fake = FakeEC2([], clock.time, prices, {k: d for k, (_, d) in PLACEMENTS.items()})
+        ec2._ec2.clients = {'us-east-1': fake.connection(region='us-east-1')}
+        ec2._ec2_paginated.clients = {'us-east-1': fake.connection(
+            ec2.PAGINATED_API_VERSION, 'us-east-1')}
+
+        start = clock.now
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            nodes = ec2.create_servers(count, ['node'] * count, size=size,
+                                       placement=placement, bid='0.05',
+                                       image='ubuntu 14.04', security_group='default')
+        finally:
+            sys.stdout = stdout
+            cache.flush()
+            fake.close()
+
+        kept = set(n['id'] for n in nodes)
+        cost = sum(PLACEMENTS[(r['size'], r['zone'])][0] for r in fake.spot_requests
+                   if r['instance_id'] in kept)
+        print '%12s  %10d  %10.2f  %8d' % (method, clock.now - start, cost, len(fake.requests))
+
+if __name__ == '__main__':
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
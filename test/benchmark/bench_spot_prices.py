@@ -0,0 +1,97 @@
+'''
+Measure fetching a day of spot price history from a fake EC2 endpoint
+and computing per-type statistics, fetching the whole day on every run
+with statistics over Python lists, versus fetching only what's changed
+since the last run with statistics computed by NumPy.
+
+Usage:
+    python test/benchmark/bench_spot_prices.py [types] [zones]
+'''
+
+import os
+import sys
+import time
+import random
+
+for name in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY',
+             'AWS_SSH_KEY_FILENAME', 'AWS_KEYPAIR_NAME']:
+    os.environ.setdefault(name, 'x')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'unit'))
+
+from headintheclouds import ec2, cache, util
+from fake_ec2 import FakeEC2
+
+DAY = 24 * 60 * 60
+
+def make_spot_prices(zones, types, start, end, interval=300):
+    prices = []
+    for zone in zones:
+        for instance_type in types:
+            for t in range(start, end, interval):
+                prices.append({'zone': zone, 'type': instance_type,
+                               'price': round(random.uniform(0.01, 1), 4),
+                               'timestamp': ec2._timestamp(t)})
+    return prices
+
+def full(zones):
+    histories = {}
+    for zone in zones:
+        histories[zone] = [(x.timestamp, x.instance_type, x.price) for x in ec2._spot_prices(
+            zone, ec2._timestamp(time.time() - DAY), ec2._timestamp(time.time()))]
+    return full_stats(histories)
+
+def incremental(zones):
+    histories = util.parallel_map(ec2.spot_price_history, zones)
+    return ec2.spot_price_stats(dict(zip(zones, histories)))
+
+def bench(n_types=50, n_zones=3):
+    cache.FILENAME = 'tmp_bench_spot_prices.db'
+    random.seed(0)
+
+    now = int(time.time())
+    zones = ['us-east-1%s' % z for z in 'abcdefgh'[:n_zones]]
+    fake = FakeEC2([], spot_prices=make_spot_prices(
+        zones, ['type-%d' % i for i in range(n_types)], now - 2 * DAY, now))
+    ec2._ec2_paginated.clients = {'us-east-1': fake.connection(
+        ec2.PAGINATED_API_VERSION, 'us-east-1')}
+
+    print '%8s  %12s  %10s  %12s  %8s' % ('run', 'method', 'time (ms)', 'bytes', 'requests')
+    try:
+        for run in ['cold', 'warm']:
+            for fn in [full, incremental]:
+                del fake.requests[:]
+                start = time.time()
+                fn(zones)
+                elapsed = (time.time() - start) * 1000.0
+                print '%8s  %12s  %10.1f  %12d  %8d' % (
+                    run, fn.__name__, elapsed, sum(size for _, size in fake.requests),
+                    len(fake.requests))
+            # prices keep changing between runs
+            time.sleep(1)
+
+        histories = {z: ec2.spot_price_history(z) for z in zones}
+    finally:
+        cache.flush()
+        fake.close()
+
+    for name, stats in [('python', lambda: full_stats(histories)),
+                        ('numpy', lambda: ec2.spot_price_stats(histories))]:
+        start = time.time()
+        stats()
+        print '%8s  %12s  %10.1f' % ('stats', name, (time.time() - start) * 1000.0)
+
+def full_stats(histories):
+    # what pricing() did before, for every zone
+    stats = {}
+    for zone, history in histories.items():
+        data = {}
+        for t, instance_type, price in history:
+            data.setdefault(instance_type, []).append((t, price))
+        for instance_type, rows in data.items():
+            prices = [p for _, p in rows]
+            stats[(zone, instance_type)] = (
+                max(rows)[1], util.median(prices), util.stddev(prices), max(prices))
+    return stats
+
+if __name__ == '__main__':
+    bench(*[int(x) for x in sys.argv[1:3]])
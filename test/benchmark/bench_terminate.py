@@ -0,0 +1,73 @@
+'''
+Measure terminating a fleet of EC2 nodes against a fake EC2 endpoint,
+one forked process and TerminateInstances call per host like
+`fab terminate` does, versus one call for all of them like
+`fab terminate_batch`.
+
+Usage:
+    python test/benchmark/bench_terminate.py [nodes]
+'''
+
+import os
+import sys
+import time
+import multiprocessing
+
+for name in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY',
+             'AWS_SSH_KEY_FILENAME', 'AWS_KEYPAIR_NAME']:
+    os.environ.setdefault(name, 'x')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'unit'))
+
+from fabric.api import env
+from headintheclouds import ec2, cache
+from fake_ec2 import FakeEC2, make_instances
+
+def per_host(fake, nodes):
+    def terminate(host):
+        # like fabric's @parallel, with a fresh connection per process
+        ec2._ec2.clients = {ec2.DEFAULT_REGION: fake.connection(region=ec2.DEFAULT_REGION)}
+        env.host = host
+        ec2.terminate()
+
+    processes = [multiprocessing.Process(target=terminate, args=(n['ip'],))
+                 for n in nodes]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+def batched(fake, nodes):
+    ec2.terminate_nodes(nodes)
+
+def bench(count=200):
+    cache.FILENAME = 'tmp_bench_terminate.db'
+    devnull = open(os.devnull, 'w')
+
+    print '%10s  %10s  %10s  %8s' % ('nodes', 'method', 'time (ms)', 'requests')
+    try:
+        for fn in [per_host, batched]:
+            fake = FakeEC2(make_instances(count, managed_every=1))
+            ec2.REGIONS = [ec2.DEFAULT_REGION]
+            ec2._ec2.clients = {ec2.DEFAULT_REGION: fake.connection(region=ec2.DEFAULT_REGION)}
+            ec2._ec2_paginated.clients = {ec2.DEFAULT_REGION: fake.connection(
+                ec2.PAGINATED_API_VERSION, ec2.DEFAULT_REGION)}
+            try:
+                nodes = cache.recache(ec2.all_nodes)
+                del fake.requests[:]
+
+                stdout, sys.stdout = sys.stdout, devnull
+                start = time.time()
+                try:
+                    fn(fake, nodes)
+                finally:
+                    sys.stdout = stdout
+                elapsed = (time.time() - start) * 1000.0
+                print '%10d  %10s  %10.1f  %8d' % (
+                    len(nodes), fn.__name__, elapsed, fake.calls('TerminateInstances'))
+            finally:
+                fake.close()
+    finally:
+        cache.flush()
+
+if __name__ == '__main__':
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -0,0 +1,452 @@
+'''
+A local HTTP server answering EC2 DescribeInstances,
+DescribeInstanceStatus, RunInstances, CreateTags, TerminateInstances,
+RebootInstances, DescribeSpotPriceHistory and spot instance request
+requests from an in-memory list of instances and spot prices. It supports instance IDs, state and tag
+filters and MaxResults/NextToken pagination, and records every request
+with the size of its response.
+
+Instances with a running_at time are pending until clock() reaches it.
+Spot requests for a (size, zone) in spot_delays are fulfilled that many
+seconds after they're made, the others stay open.
+'''
+
+import fnmatch
+import threading
+import urlparse
+import BaseHTTPServer
+from xml.sax.saxutils import escape
+
+import boto.ec2.connection
+from boto.regioninfo import RegionInfo
+
+INSTANCE_XML = '''
+    <item>
+      <instanceId>i-%(id)s</instanceId>
+      <imageId>ami-1e917676</imageId>
+      <instanceState><code>16</code><name>%(state)s</name></instanceState>
+      <privateDnsName>ip-10-0-0-1.ec2.internal</privateDnsName>
+      <dnsName>ec2-54-0-0-1.compute-1.amazonaws.com</dnsName>
+      <instanceType>m1.small</instanceType>
+      <launchTime>2014-01-01T00:00:00.000Z</launchTime>
+      <placement><availabilityZone>us-east-1b</availabilityZone></placement>
+      <privateIpAddress>%(internal_ip)s</privateIpAddress>
+      <ipAddress>%(ip)s</ipAddress>
+      <groupSet><item><groupId>sg-12345678</groupId><groupName>default</groupName></item></groupSet>
+      <tagSet><item><key>Name</key><value>%(name)s</value></item></tagSet>
+    </item>'''
+
+RESERVATION_XML = '''
+<item>
+  <reservationId>r-%s</reservationId>
+  <ownerId>123456789012</ownerId>
+  <groupSet/>
+  <instancesSet>%s
+  </instancesSet>
+</item>'''
+
+RUN_INSTANCES_RESPONSE_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<RunInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2014-10-01/">
+  <requestId>fake</requestId>
+  <reservationId>r-%s</reservationId>
+  <ownerId>123456789012</ownerId>
+  <groupSet/>
+  <instancesSet>%s
+  </instancesSet>
+</RunInstancesResponse>'''
+
+CREATE_TAGS_RESPONSE_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<CreateTagsResponse xmlns="http://ec2.amazonaws.com/doc/2014-10-01/">
+  <requestId>fake</requestId>
+  <return>true</return>
+</CreateTagsResponse>'''
+
+TERMINATE_INSTANCES_RESPONSE_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<TerminateInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2014-10-01/">
+  <requestId>fake</requestId>
+  <instancesSet>%s</instancesSet>
+</TerminateInstancesResponse>'''
+
+TERMINATING_XML = '''
+<item>
+  <instanceId>i-%s</instanceId>
+  <currentState><code>32</code><name>shutting-down</name></currentState>
+  <previousState><code>16</code><name>running</name></previousState>
+</item>'''
+
+REBOOT_INSTANCES_RESPONSE_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<RebootInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2014-10-01/">
+  <requestId>fake</requestId>
+  <return>true</return>
+</RebootInstancesResponse>'''
+
+RESPONSE_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<DescribeInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2014-10-01/">
+  <requestId>fake</requestId>
+  <reservationSet>%s</reservationSet>%s
+</DescribeInstancesResponse>'''
+
+SPOT_PRICE_XML = '''
+<item>
+  <instanceType>%(type)s</instanceType>
+  <productDescription>Linux/UNIX</productDescription>
+  <spotPrice>%(price)s</spotPrice>
+  <timestamp>%(timestamp)s</timestamp>
+  <availabilityZone>%(zone)s</availabilityZone>
+</item>'''
+
+SPOT_PRICE_RESPONSE_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<DescribeSpotPriceHistoryResponse xmlns="http://ec2.amazonaws.com/doc/2014-10-01/">
+  <requestId>fake</requestId>
+  <spotPriceHistorySet>%s</spotPriceHistorySet>%s
+</DescribeSpotPriceHistoryResponse>'''
+
+SPOT_REQUEST_XML = '''
+<item>
+  <spotInstanceRequestId>sir-%(id)s</spotInstanceRequestId>
+  <spotPrice>%(price)s</spotPrice>
+  <type>one-time</type>
+  <state>%(state)s</state>
+  <status><code>%(status)s</code></status>
+  <launchSpecification>
+    <instanceType>%(size)s</instanceType>
+    <placement><availabilityZone>%(zone)s</availabilityZone></placement>
+  </launchSpecification>%(instance)s
+</item>'''
+
+CANCELLED_SPOT_REQUEST_XML = '''
+<item>
+  <spotInstanceRequestId>sir-%(id)s</spotInstanceRequestId>
+  <state>%(state)s</state>
+</item>'''
+
+SPOT_REQUESTS_RESPONSE_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<%(action)sResponse xmlns="http://ec2.amazonaws.com/doc/2014-10-01/">
+  <requestId>fake</requestId>
+  <spotInstanceRequestSet>%(items)s</spotInstanceRequestSet>
+</%(action)sResponse>'''
+
+STATUS_XML = '''
+<item>
+  <instanceId>i-%(id)s</instanceId>
+  <availabilityZone>us-east-1b</availabilityZone>
+  <instanceState><code>0</code><name>%(state)s</name></instanceState>
+  <systemStatus><status>ok</status></systemStatus>
+  <instanceStatus><status>ok</status></instanceStatus>
+</item>'''
+
+STATUS_RESPONSE_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<DescribeInstanceStatusResponse xmlns="http://ec2.amazonaws.com/doc/2014-10-01/">
+  <requestId>fake</requestId>
+  <instanceStatusSet>%s</instanceStatusSet>
+</DescribeInstanceStatusResponse>'''
+
+def make_instances(count, prefix='HITC-', managed_every=10):
+    '''
+    count instances where every managed_every'th one is named with
+    prefix, and a quarter of the rest are terminated.
+    '''
+    instances = []
+    for i in range(count):
+        managed = i % managed_every == 0
+        instances.append({
+            'id': '%08x' % i,
+            'name': '%snode-%d' % (prefix if managed else 'other-', i),
+            'state': 'terminated' if not managed and i % 4 == 1 else 'running',
+            'ip': '54.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+            'internal_ip': '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+        })
+    return instances
+
+def _filters(params):
+    filters = {}
+    i = 1
+    while 'Filter.%d.Name' % i in params:
+        values = []
+        j = 1
+        while 'Filter.%d.Value.%d' % (i, j) in params:
+            values.append(params['Filter.%d.Value.%d' % (i, j)])
+            j += 1
+        filters[params['Filter.%d.Name' % i]] = values
+        i += 1
+    return filters
+
+def _list(params, name):
+    values = []
+    i = 1
+    while '%s.%d' % (name, i) in params:
+        values.append(params['%s.%d' % (name, i)])
+        i += 1
+    return values
+
+def _instance_xml(instance):
+    return INSTANCE_XML % dict((k, escape(str(v))) for k, v in instance.items())
+
+def _matches(instance, filters):
+    for name, values in filters.items():
+        if name == 'instance-state-name':
+            value = instance['state']
+        elif name == 'tag:Name':
+            value = instance['name']
+        elif name == 'instance-id':
+            value = 'i-' + instance['id']
+        else:
+            raise ValueError('Unsupported filter: %s' % name)
+        # EC2 filters match * and ?, and \ escapes them
+        if not any(fnmatch.fnmatchcase(value, v.replace('\\*', '[*]').replace('\\?', '[?]'))
+                   for v in values):
+            return False
+    return True
+
+class FakeEC2(object):
+
+    def __init__(self, instances, clock=None, spot_prices=None, spot_delays=None):
+        self.instances = instances
+        self.spot_prices = spot_prices or []
+        self.spot_delays = spot_delays or {}
+        self.spot_requests = []
+        self.clock = clock
+        self.requests = []
+
+        fake = self
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.respond(self.rfile.read(int(self.headers['Content-Length'])))
+
+            def do_GET(self):
+                self.respond(urlparse.urlparse(self.path).query)
+
+            def respond(self, query):
+                params = dict((k, v[0]) for k, v in urlparse.parse_qs(query).items())
+                response = {
+                    'DescribeInstances': fake.describe_instances,
+                    'DescribeInstanceStatus': fake.describe_instance_status,
+                    'RunInstances': fake.run_instances,
+                    'CreateTags': fake.create_tags,
+                    'TerminateInstances': fake.terminate_instances,
+                    'RebootInstances': fake.reboot_instances,
+                    'DescribeSpotPriceHistory': fake.describe_spot_price_history,
+                    'RequestSpotInstances': fake.request_spot_instances,
+                    'DescribeSpotInstanceRequests': fake.describe_spot_instance_requests,
+                    'CancelSpotInstanceRequests': fake.cancel_spot_instance_requests,
+                }[params['Action']](params)
+                fake.requests.append((params, len(response)))
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/xml')
+                self.send_header('Content-Length', str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def state(self, instance):
+        if 'running_at' in instance:
+            return 'running' if self.clock() >= instance['running_at'] else 'pending'
+        return instance['state']
+
+    def calls(self, action):
+        return len([p for p, _ in self.requests if p['Action'] == action])
+
+    def describe_instances(self, params):
+        filters = _filters(params)
+        ids = set(_list(params, 'InstanceId'))
+        if ids:
+            assert 'MaxResults' not in params
+            filters['instance-id'] = ['i-' + x['id'] for x in self.instances
+                                      if 'i-' + x['id'] in ids]
+        instances = [dict(x, state=self.state(x)) for x in self.instances]
+        instances = [x for x in instances if _matches(x, filters)]
+
+        next_token = ''
+        if 'MaxResults' in params:
+            start = int(params.get('NextToken', 0))
+            end = start + int(params['MaxResults'])
+            if end < len(instances):
+                next_token = '\n  <nextToken>%d</nextToken>' % end
+            instances = instances[start:end]
+
+        return RESPONSE_XML % (
+            ''.join(RESERVATION_XML % (x['id'], _instance_xml(x)) for x in instances),
+            next_token)
+
+    def describe_instance_status(self, params):
+        assert params['IncludeAllInstances'] == 'true'
+        ids = set(_list(params, 'InstanceId'))
+        return STATUS_RESPONSE_XML % ''.join(
+            STATUS_XML % {'id': x['id'], 'state': self.state(x)}
+            for x in self.instances if 'i-' + x['id'] in ids)
+
+    def create_instances(self, count, start_time):
+        created = make_instances(len(self.instances) + count, prefix='',
+                                 managed_every=1)[len(self.instances):]
+        for instance in created:
+            instance['name'] = ''
+            instance['running_at'] = self.clock() + start_time
+        self.instances += created
+        return created
+
+    def run_instances(self, params, start_time=20):
+        created = self.create_instances(int(params['MaxCount']), start_time)
+        return RUN_INSTANCES_RESPONSE_XML % (
+            created[0]['id'], ''.join(_instance_xml(dict(x, state='pending'))
+                                      for x in created))
+
+    def create_tags(self, params):
+        assert params['Tag.1.Key'] == 'Name'
+        ids = set(_list(params, 'ResourceId'))
+        for instance in self.instances:
+            if 'i-' + instance['id'] in ids:
+                instance['name'] = params['Tag.1.Value']
+        return CREATE_TAGS_RESPONSE_XML
+
+    def terminate_instances(self, params):
+        ids = set(_list(params, 'InstanceId'))
+        terminated = [x for x in self.instances if 'i-' + x['id'] in ids]
+        for instance in terminated:
+            instance.pop('running_at', None)
+            instance['state'] = 'shutting-down'
+        return TERMINATE_INSTANCES_RESPONSE_XML % ''.join(
+            TERMINATING_XML % x['id'] for x in terminated)
+
+    def reboot_instances(self, params):
+        assert _list(params, 'InstanceId')
+        return REBOOT_INSTANCES_RESPONSE_XML
+
+    def describe_spot_price_history(self, params):
+        '''
+        The prices in spot_prices (dicts of zone, type, price and
+        timestamp) between StartTime and EndTime, and like EC2 the last
+        price of each type before StartTime, newest first.
+        '''
+        prices = [x for x in self.spot_prices
+                  if x['zone'] == params['AvailabilityZone']
+                  and x['timestamp'] <= params['EndTime']]
+        before = {}
+        for price in prices:
+            if price['timestamp'] < params['StartTime']:
+                if (price['type'] not in before
+                    or before[price['type']]['timestamp'] < price['timestamp']):
+                    before[price['type']] = price
+        prices = [x for x in prices if x['timestamp'] >= params['StartTime']] + before.values()
+        prices.sort(key=lambda x: x['timestamp'], reverse=True)
+
+        start = int(params.get('NextToken', 0))
+        end = start + int(params['MaxResults'])
+        next_token = ''
+        if end < len(prices):
+            next_token = '\n  <nextToken>%d</nextToken>' % end
+        return SPOT_PRICE_RESPONSE_XML % (
+            ''.join(SPOT_PRICE_XML % x for x in prices[start:end]), next_token)
+
+    def request_spot_instances(self, params):
+        created = []
+        for _ in range(int(params['InstanceCount'])):
+            created.append({
+                'id': '%08x' % len(self.spot_requests),
+                'price': params['SpotPrice'],
+                'size': params['LaunchSpecification.InstanceType'],
+                'zone': params['LaunchSpecification.Placement.AvailabilityZone'],
+                'created': self.clock(),
+                'state': 'open',
+                'instance_id': None,
+            })
+            self.spot_requests.append(created[-1])
+        return self.spot_requests_xml('RequestSpotInstances', created)
+
+    def describe_spot_instance_requests(self, params):
+        ids = set(_list(params, 'SpotInstanceRequestId'))
+        requests = [r for r in self.spot_requests if 'sir-' + r['id'] in ids]
+        for r in requests:
+            delay = self.spot_delays.get((r['size'], r['zone']))
+            if (r['state'] == 'open' and delay is not None
+                and self.clock() >= r['created'] + delay):
+                r['state'] = 'active'
+                r['instance_id'] = 'i-' + self.create_instances(1, 0)[0]['id']
+        return self.spot_requests_xml('DescribeSpotInstanceRequests', requests)
+
+    def cancel_spot_instance_requests(self, params):
+        ids = set(_list(params, 'SpotInstanceRequestId'))
+        requests = [r for r in self.spot_requests if 'sir-' + r['id'] in ids]
+        for r in requests:
+            if r['state'] == 'open':
+                r['state'] = 'cancelled'
+        return SPOT_REQUESTS_RESPONSE_XML % {
+            'action': 'CancelSpotInstanceRequests',
+            'items': ''.join(CANCELLED_SPOT_REQUEST_XML % r for r in requests)}
+
+    def spot_requests_xml(self, action, requests):
+        return SPOT_REQUESTS_RESPONSE_XML % {'action': action, 'items': ''.join(
+            SPOT_REQUEST_XML % dict(r, status={'open': 'pending-fulfillment',
+                                               'active': 'fulfilled',
+                                               'cancelled': 'canceled-before-fulfillment'}[r['state']],
+                                    instance='\n  <instanceId>%s</instanceId>' % r['instance_id']
+                                    if r['instance_id'] else '')
+            for r in requests)}
+
+    def connection(self, api_version=None, region='fake'):
+        host, port = self.server.server_address
+        return boto.ec2.connection.EC2Connection(
+            'fake', 'fake', is_secure=False, port=port,
+            region=RegionInfo(name=region, endpoint=host),
+            api_version=api_version)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+PRICING_JSONP = '''callback({"config": {"regions": [
+  {"region": "us-east", "instanceTypes": [
+    {"type": "generalCurrentGen", "sizes": [
+      {"size": "m3.medium", "vCPU": "1", "ECU": "3", "memoryGiB": "3.75", "storageGB": "1 x 4 SSD",
+       "valueColumns": [{"name": "linux", "prices": {"USD": "%s"}}]}]},
+    {"type": "gpuCurrentGen", "sizes": [
+      {"size": "g2.2xlarge", "vCPU": "8", "ECU": "26", "memoryGiB": "15", "storageGB": "60 SSD",
+       "valueColumns": [{"name": "linux", "prices": {"USD": "0.650"}}]}]}]},
+  {"region": "eu-ireland", "instanceTypes": []}]}})'''
+
+class FakePricing(object):
+    '''
+    A local HTTP server for the EC2 pricing catalog, which answers
+    If-None-Match requests for the current ETag with 304 Not Modified.
+    '''
+
+    def __init__(self, price='0.070'):
+        self.price = price
+        self.requests = []
+
+        fake = self
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                etag = '"%s"' % fake.price
+                fake.requests.append(dict(self.headers))
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                body = PRICING_JSONP % fake.price
+                self.send_response(200)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def url(self):
+        return 'http://%s:%d/pricing/ec2/linux-od.js' % self.server.server_address
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
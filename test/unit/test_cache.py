@@ -1,9 +1,13 @@
 import unittest2 as unittest
+import sys
 import uuid
 import time
 import collections
+import threading
+import multiprocessing
+import StringIO
 
-from headintheclouds import cache
+from headintheclouds import cache, util
 
 class TestCache(unittest.TestCase):
 
@@ -136,5 +140,304 @@ class TestCache(unittest.TestCase):
         self.assertEquals(cache.get('foo'), 'baz')
         self.assertEquals(cache.size(), 1)
 
+    def test_cached_ttl_stale(self):
+        times_called = collections.Counter()
+
+        @cache.cached(ttl=0.5, stale_ttl=60)
+        def foo():
+            times_called['n'] += 1
+            return times_called['n']
+
+        self.assertEquals(foo(), 1)
+        self.assertEquals(foo(), 1)
+        time.sleep(0.6)
+
+        # stale value is returned while the refresh runs
+        self.assertEquals(foo(), 1)
+        for thread in cache._refreshing.values():
+            thread.join()
+
+        self.assertEquals(times_called['n'], 2)
+        self.assertEquals(foo(), 2)
+
+    def test_cached_ttl_expired(self):
+        times_called = collections.Counter()
+
+        @cache.cached(ttl=0.5)
+        def foo():
+            times_called['n'] += 1
+            return times_called['n']
+
+        self.assertEquals(foo(), 1)
+        time.sleep(0.6)
+        self.assertEquals(foo(), 2)
+        self.assertEquals(cache._refreshing, {})
+
+    def test_cached_none(self):
+        times_called = collections.Counter()
+
+        @cache.cached
+        def foo():
+            times_called['n'] += 1
+            return None
+
+        self.assertIsNone(foo())
+        self.assertIsNone(foo())
+        self.assertIsNone(foo())
+        self.assertEquals(times_called['n'], 1)
+
+    def test_cached_error(self):
+        times_called = collections.Counter()
+
+        @cache.cached(error_ttl=0.5)
+        def foo():
+            times_called['n'] += 1
+            if times_called['n'] == 1:
+                raise ValueError('failed')
+            return 'ok'
+
+        self.assertRaises(ValueError, foo)
+        self.assertRaises(ValueError, foo)
+        self.assertRaises(ValueError, foo)
+        self.assertEquals(times_called['n'], 1)
+
+        time.sleep(0.6)
+        self.assertEquals(foo(), 'ok')
+        self.assertEquals(foo(), 'ok')
+        self.assertEquals(times_called['n'], 2)
+
+    def test_cached_unpicklable_error(self):
+        times_called = collections.Counter()
+
+        @cache.cached(error_ttl=10)
+        def foo():
+            times_called['n'] += 1
+            raise UnpicklableError('resp', 'content')
+
+        self.assertRaises(UnpicklableError, foo)
+        cache._memory.clear()
+        self.assertRaises(UnpicklableError, foo)
+        self.assertEquals(times_called['n'], 2)
+
+    def test_get_unpicklable(self):
+        key = randstr()
+        cache.set(key, UnpicklableError('resp', 'content'))
+        cache._memory.clear()
+        self.assertIsNone(cache.get(key))
+        self.assertEquals(cache._db().cursor.execute(
+            'SELECT COUNT(*) FROM cache WHERE key = ?', (key,)).fetchone()[0], 0)
+
+    def test_make_key(self):
+        def foo():
+            pass
+
+        self.assertEquals(cache.make_key(foo), 'test_cache.foo')
+        self.assertEquals(cache.make_key(foo, (1, 'a'), {'x': 1, 'y': [2]}),
+                          cache.make_key(foo, [1, 'a'], {'y': [2], 'x': 1}))
+        self.assertTrue(cache.make_key(foo, (1,)).startswith('test_cache.foo:'))
+
+        keys = [
+            cache.make_key(foo),
+            cache.make_key(foo, (1,)),
+            cache.make_key(foo, ('1',)),
+            cache.make_key(foo, (), {'x': 1}),
+            cache.make_key(foo, namespace=('key1', 'us-east-1', 'HITC-')),
+            cache.make_key(foo, namespace=('key2', 'us-east-1', 'HITC-')),
+            cache.make_key(foo, namespace=('key1', 'us-west-2', 'HITC-')),
+            cache.make_key(foo, namespace=('key1', 'us-east-1', 'TEST-')),
+            cache.make_key(foo, (1,), namespace=('key1', 'us-east-1', 'HITC-')),
+        ]
+        self.assertEquals(len(keys), len(set(keys)))
+
+    def test_cached_namespace(self):
+        account = {'id': 'a'}
+        times_called = collections.Counter()
+
+        @cache.cached(namespace=lambda: account['id'])
+        def foo():
+            times_called[account['id']] += 1
+            return account['id']
+
+        self.assertEquals(foo(), 'a')
+        account['id'] = 'b'
+        self.assertEquals(foo(), 'b')
+        account['id'] = 'a'
+        self.assertEquals(foo(), 'a')
+        self.assertEquals(times_called, {'a': 1, 'b': 1})
+
+    def test_memory_hits(self):
+        key = randstr()
+        value = {randstr(): [randstr()]}
+        cache.set(key, value)
+        before = cache.stats()
+
+        cache._cursor = None
+        for _ in range(3):
+            self.assertEquals(cache.get(key), value)
+        self.assertIsNone(cache._cursor)
+
+        after = cache.stats()
+        self.assertEquals(after.get('memory_hits', 0) - before.get('memory_hits', 0), 3)
+        self.assertEquals(after.get('disk_hits', 0), before.get('disk_hits', 0))
+
+    def test_memory_invalidate(self):
+        key = randstr()
+        cache.set(key, 'foo')
+        self.assertEquals(cache.get(key), 'foo')
+        cache.set(key, 'bar')
+        self.assertEquals(cache.get(key), 'bar')
+        cache.delete(key)
+        self.assertIsNone(cache.get(key))
+
+    def test_memory_print_table(self):
+        key = randstr()
+        cache.set(key, [{'name': 'b'}, {'name': 'a'}])
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            util.print_table(cache.get(key), ['name'], sort='name')
+        finally:
+            sys.stdout = stdout
+        self.assertEquals(cache.get(key), [{'name': 'b'}, {'name': 'a'}])
+
+    def test_memory_lru(self):
+        keys = [randstr() for _ in range(cache.MEMORY_SIZE + 1)]
+        for key in keys:
+            cache.set(key, key)
+        self.assertEquals(len(cache._memory), cache.MEMORY_SIZE)
+
+        before = cache.stats()
+        self.assertEquals(cache.get(keys[0]), keys[0])
+        after = cache.stats()
+        self.assertEquals(after.get('disk_hits', 0) - before.get('disk_hits', 0), 1)
+
+    def test_sweep_expired_on_open(self):
+        cache.set('foo', 'bar', 0.5)
+        cache.set('baz', 'qux')
+        time.sleep(0.6)
+
+        cache._cursor = None
+        self.assertEquals(cache.size(), 1)
+        self.assertEquals(cache.get('baz'), 'qux')
+
+    def test_evict_entries(self):
+        original_max_entries = cache.MAX_ENTRIES
+        cache.MAX_ENTRIES = 5
+        try:
+            for i in range(8):
+                cache.set('key-%d' % i, i)
+            cache.get('key-0')
+            cache.compact()
+        finally:
+            cache.MAX_ENTRIES = original_max_entries
+
+        self.assertEquals(cache.size(), 5)
+        self.assertEquals(cache.get('key-0'), 0)
+        for i in range(1, 4):
+            self.assertIsNone(cache.get('key-%d' % i))
+        for i in range(4, 8):
+            self.assertEquals(cache.get('key-%d' % i), i)
+
+    def test_evict_bytes(self):
+        original_max_bytes = cache.MAX_BYTES
+        cache.MAX_BYTES = 2500
+        try:
+            for i in range(5):
+                cache.set('key-%d' % i, 'x' * 1000)
+            cache.compact()
+        finally:
+            cache.MAX_BYTES = original_max_bytes
+
+        self.assertEquals(cache.size(), 2)
+        self.assertLessEqual(cache.stats()['bytes'], 2500)
+        self.assertEquals(cache.biggest(1)[0]['key'], 'key-3')
+
+    def test_stats(self):
+        cache.set('foo', 'bar')
+        cache.set('big', 'x' * 1000)
+        cache.get('foo')
+        cache.get('nonexistent')
+        cache._save_stats()
+        cache.get('foo')
+
+        stats = cache.stats()
+        self.assertEquals(stats['entries'], 2)
+        self.assertGreater(stats['bytes'], 1000)
+        self.assertGreater(stats['file_bytes'], stats['bytes'])
+        self.assertEquals(stats['memory_hits'], 2)
+        self.assertEquals(stats['misses'], 1)
+        self.assertEquals([e['key'] for e in cache.biggest()], ['big', 'foo'])
+
+    def test_concurrent_writers(self):
+        n_processes = 32
+        n_keys = 20
+
+        # open the database in the parent so the workers inherit the
+        # connection, like the forked ensemble processes do
+        cache.set('parent', 'value')
+
+        def write(i):
+            for j in range(n_keys):
+                cache.set('%d-%d' % (i, j), [i, j])
+            cache.delete('%d-0' % i)
+
+        processes = [multiprocessing.Process(target=write, args=(i,))
+                     for i in range(n_processes)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEquals(process.exitcode, 0)
+
+        self.assertEquals(cache.get('parent'), 'value')
+        for i in range(n_processes):
+            self.assertIsNone(cache.get('%d-0' % i))
+            for j in range(1, n_keys):
+                self.assertEquals(cache.get('%d-%d' % (i, j)), [i, j])
+        self.assertEquals(cache.size(), n_processes * (n_keys - 1) + 1)
+
+        cache._cursor = None
+        integrity = cache._db().cursor.execute('PRAGMA integrity_check').fetchone()
+        self.assertEquals(integrity[0], 'ok')
+
+    def test_fork_while_locked(self):
+        cache.set('foo', 'bar')
+        cache._refreshing['stale'] = None
+
+        # fork while a refresh thread holds the lock
+        locked = threading.Event()
+        release = threading.Event()
+        def refresh():
+            with cache._lock:
+                locked.set()
+                release.wait()
+        thread = threading.Thread(target=refresh)
+        thread.start()
+        locked.wait()
+
+        def child():
+            assert cache.get('foo') == 'bar'
+            assert not cache._refreshing
+
+        try:
+            process = multiprocessing.Process(target=child)
+            process.start()
+            process.join(10)
+            if process.is_alive():
+                process.terminate()
+            self.assertEquals(process.exitcode, 0)
+        finally:
+            release.set()
+            thread.join()
+            cache._refreshing.clear()
+
+class UnpicklableError(Exception):
+
+    # like googleapiclient's HttpError, which pickles its args but
+    # can't be created from them
+    def __init__(self, resp, content):
+        super(UnpicklableError, self).__init__()
+        self.resp = resp
+        self.content = content
+
 def randstr():
     return str(uuid.uuid4())
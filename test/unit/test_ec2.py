@@ -0,0 +1,496 @@
+import os
+import random
+import shutil
+import socket
+import tempfile
+import StringIO
+import sys
+import unittest2 as unittest
+
+from fabric.api import env
+
+from headintheclouds import ec2, cache, util
+from fake_ec2 import FakeEC2, FakePricing, make_instances
+
+class EC2TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.original_filename = cache.FILENAME
+        cache.FILENAME = 'tmp_test_cache.db'
+        self.original_page_size = ec2.PAGE_SIZE
+        self.original_prefix = env.name_prefix
+        self.original_regions = ec2.REGIONS
+        self.original_default_region = ec2.DEFAULT_REGION
+        self.fakes = []
+
+    def tearDown(self):
+        cache.flush()
+        cache.FILENAME = self.original_filename
+        ec2.PAGE_SIZE = self.original_page_size
+        env.name_prefix = self.original_prefix
+        ec2.REGIONS = self.original_regions
+        ec2.DEFAULT_REGION = self.original_default_region
+        ec2._ec2_paginated.clients = {}
+        ec2._ec2.clients = {}
+        for fake in self.fakes:
+            fake.close()
+
+    def fake_ec2(self, instances, regions=['fake'], clock=None, spot_prices=None,
+                 spot_delays=None):
+        ec2.REGIONS = regions
+        ec2.DEFAULT_REGION = regions[0]
+        ec2._ec2_paginated.clients = {}
+        ec2._ec2.clients = {}
+        for region in regions:
+            fake = FakeEC2(instances, clock, spot_prices, spot_delays)
+            ec2._ec2_paginated.clients[region] = fake.connection(
+                ec2.PAGINATED_API_VERSION, region)
+            ec2._ec2.clients[region] = fake.connection(region=region)
+            self.fakes.append(fake)
+        self.fake = self.fakes[0]
+
+class TestAllNodes(EC2TestCase):
+
+    def test_filters(self):
+        instances = make_instances(100)
+        instances[0]['state'] = 'terminated'
+        instances[10]['state'] = 'shutting-down'
+        instances[20]['state'] = 'stopped'
+        self.fake_ec2(instances)
+
+        nodes = cache.recache(ec2.all_nodes)
+        self.assertEquals(sorted(n['name'] for n in nodes),
+                          sorted('node-%d' % i for i in range(20, 100, 10)))
+        self.assertEquals(nodes[0]['ip'], '54.0.0.20')
+        self.assertEquals(nodes[0]['size'], 'm1.small')
+        self.assertEquals(len(self.fake.requests), 1)
+
+    def test_pagination(self):
+        self.fake_ec2(make_instances(1000, managed_every=3))
+        ec2.PAGE_SIZE = 100
+        nodes = cache.recache(ec2.all_nodes)
+        self.assertEquals(len(nodes), 334)
+        self.assertEquals(len(set(n['id'] for n in nodes)), 334)
+        self.assertEquals(len(self.fake.requests), 4)
+
+    def test_prefix_wildcards(self):
+        env.name_prefix = 'A*-'
+        instances = make_instances(10, prefix='A*-')
+        instances[1]['name'] = 'AB-node-1'
+        instances[1]['state'] = 'running'
+        self.fake_ec2(instances)
+        nodes = cache.recache(ec2.all_nodes)
+        self.assertEquals([n['name'] for n in nodes], ['node-0'])
+
+    def test_no_prefix(self):
+        env.name_prefix = ''
+        self.fake_ec2(make_instances(40))
+        nodes = cache.recache(ec2.all_nodes)
+        self.assertEquals(len(nodes), 30)
+
+    def test_regions(self):
+        self.fake_ec2(make_instances(30), regions=['us-east-1', 'eu-west-1'])
+        nodes = cache.recache(ec2.all_nodes)
+        self.assertEquals(sorted((n['region'], n['name']) for n in nodes),
+                          sorted((r, 'node-%d' % i)
+                                 for r in ['us-east-1', 'eu-west-1']
+                                 for i in range(0, 30, 10)))
+
+    def test_zone_region(self):
+        self.fake_ec2([])
+        self.assertEquals(ec2._zone_region('eu-west-1c'), 'eu-west-1')
+        self.assertIsNone(ec2._zone_region(None))
+
+class FakeTime(object):
+
+    def __init__(self):
+        self.now = 0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+class TestWaiters(EC2TestCase):
+
+    def setUp(self):
+        super(TestWaiters, self).setUp()
+        self.original_time = ec2.time
+        ec2.time = self.fake_time = FakeTime()
+
+    def tearDown(self):
+        ec2.time = self.original_time
+        super(TestWaiters, self).tearDown()
+
+    def test_wait_for_instances_to_start(self):
+        instances = make_instances(50, managed_every=1)
+        for i, instance in enumerate(instances):
+            instance['running_at'] = 20 + i * 0.5
+        self.fake_ec2(instances, clock=self.fake_time.time)
+
+        ec2.wait_for_instances_to_start(['i-%s' % x['id'] for x in instances])
+
+        # one request for all 50 instances per poll, polling less
+        # often as time goes by, and not much later than the last
+        # instance started
+        self.assertLess(len(self.fake.requests), 15)
+        self.assertEquals(len(self.fake_time.sleeps), len(self.fake.requests) - 1)
+        self.assertGreaterEqual(self.fake_time.now, 44.5)
+        self.assertLess(self.fake_time.now, 44.5 + 15)
+        self.assertLessEqual(max(self.fake_time.sleeps), 15)
+
+    def test_backoff(self):
+        delays = [d for d, _ in zip(util.backoff(initial=1, maximum=10, factor=2, jitter=0.5),
+                                    range(10))]
+        for delay, upper in zip(delays, [1, 2, 4, 8, 10, 10, 10, 10, 10, 10]):
+            self.assertLessEqual(delay, upper)
+            self.assertGreaterEqual(delay, upper * 0.5)
+
+class TestCreate(EC2TestCase):
+
+    def setUp(self):
+        super(TestCreate, self).setUp()
+        self.original_time = ec2.time
+        ec2.time = self.fake_time = FakeTime()
+        self.original_reachable = util.reachable
+        util.reachable = lambda hosts, port: set(hosts)
+
+    def tearDown(self):
+        ec2.time = self.original_time
+        util.reachable = self.original_reachable
+        super(TestCreate, self).tearDown()
+
+    def create(self, count, names):
+        self.fake_ec2(make_instances(1000), regions=['fake-1'], clock=self.fake_time.time)
+        return ec2.create_servers(count, names, size='m1.small', placement='fake-1b',
+                                  image='ubuntu 14.04', security_group='default')
+
+    def test_create_constant_calls(self):
+        nodes = self.create(100, ['web'] * 100)
+        self.assertEquals(len(nodes), 100)
+        self.assertEquals(set(n['name'] for n in nodes), set(['web']))
+        self.assertTrue(all(n['running'] for n in nodes))
+        self.assertEquals(self.fake.calls('RunInstances'), 1)
+        self.assertEquals(self.fake.calls('CreateTags'), 1)
+        # polling for the instances to start and become accessible
+        # doesn't depend on the number of instances
+        self.assertLess(self.fake.calls('DescribeInstanceStatus'), 10)
+        self.assertEquals(self.fake.calls('DescribeInstances'), 1)
+
+    def test_create_lists(self):
+        self.fake_ec2([], regions=['fake-1'], clock=self.fake_time.time)
+        nodes = ec2.create_servers(2, ['web'] * 2, size=['m1.small'], placement=['fake-1b'],
+                                   image='ubuntu 14.04', security_group='default')
+        self.assertEquals(len(nodes), 2)
+        self.assertEquals([(p['InstanceType'], p['Placement.AvailabilityZone'])
+                           for p, _ in self.fake.requests if p['Action'] == 'RunInstances'],
+                          [('m1.small', 'fake-1b')])
+
+    def test_create_different_names(self):
+        nodes = self.create(4, ['web', 'db', 'web', 'cache'])
+        self.assertEquals(sorted(n['name'] for n in nodes), ['cache', 'db', 'web', 'web'])
+        self.assertEquals(self.fake.calls('CreateTags'), 3)
+
+class TestBatch(EC2TestCase):
+
+    def test_terminate_nodes(self):
+        self.fake_ec2(make_instances(2000), regions=['fake-1', 'fake-2'])
+        nodes = ec2.all_nodes()
+        self.assertEquals(len(nodes), 400)
+        ec2.terminate_nodes(nodes)
+        for fake in self.fakes:
+            self.assertEquals(fake.calls('TerminateInstances'), 1)
+        self.assertEquals(cache.recache(ec2.all_nodes), [])
+
+    def test_reboot_nodes(self):
+        self.fake_ec2(make_instances(100))
+        ec2.reboot_nodes(ec2.all_nodes())
+        self.assertEquals(self.fake.calls('RebootInstances'), 1)
+        self.assertEquals(len([k for k in self.fake.requests[-1][0] if k.startswith('InstanceId.')]), 10)
+
+def make_spot_prices(zones, types, start, end, interval=300):
+    random.seed(0)
+    prices = []
+    for zone in zones:
+        for instance_type in types:
+            for t in range(start, end, interval):
+                prices.append({'zone': zone, 'type': instance_type,
+                               'price': round(random.uniform(0.01, 1), 4),
+                               'timestamp': ec2._timestamp(t)})
+    return prices
+
+class TestSpotPrices(EC2TestCase):
+
+    def setUp(self):
+        super(TestSpotPrices, self).setUp()
+        self.original_time = ec2.time
+        ec2.time = self.fake_time = FakeTime()
+        self.fake_time.now = 2 * 24 * 60 * 60
+        self.original_get_node_types = ec2.get_node_types
+        ec2.get_node_types = lambda: {
+            t: {'memory': 1, 'cores': 1, 'storage': '', 'gpu': '', 'linux_cost': 0.1}
+            for t in ['m1.small', 'c3.large']}
+
+    def tearDown(self):
+        ec2.time = self.original_time
+        ec2.get_node_types = self.original_get_node_types
+        super(TestSpotPrices, self).tearDown()
+
+    def spot_calls(self):
+        return [p for p, _ in self.fake.requests if p['Action'] == 'DescribeSpotPriceHistory']
+
+    def test_incremental(self):
+        ec2.PAGE_SIZE = 100
+        # prices every five minutes, starting before the one day window
+        # and with one of them not changing in the last day
+        prices = make_spot_prices(['fake-1a'], ['m1.small'], 0, 2 * 24 * 60 * 60)
+        prices += make_spot_prices(['fake-1a'], ['c3.large'], 0, 12 * 60 * 60)
+        self.fake_ec2([], regions=['fake-1'], spot_prices=prices)
+
+        history = ec2.spot_price_history('fake-1a')
+        self.assertEquals(len(history), 24 * 12 + 1)
+        self.assertEquals(history[0][1], 'c3.large')
+        self.assertEquals(len(self.spot_calls()), 3)
+
+        self.fake_time.now += 60 * 60
+        prices += make_spot_prices(['fake-1a'], ['m1.small'],
+                                   2 * 24 * 60 * 60, self.fake_time.now)
+        del self.fake.requests[:]
+        history = ec2.spot_price_history('fake-1a')
+        self.assertEquals(len(self.spot_calls()), 1)
+        self.assertEquals(self.spot_calls()[0]['StartTime'], ec2._timestamp(2 * 24 * 60 * 60))
+
+        cache.flush()
+        self.assertEquals(history, ec2.spot_price_history('fake-1a'))
+
+    def test_stats(self):
+        histories = {'fake-1%s' % z: [(ec2._timestamp(t), instance_type, random.random())
+                                      for t in range(100) for instance_type in ['m1.small', 'c3.large']]
+                     for z in 'ab'}
+        stats = ec2.spot_price_stats(histories)
+        self.assertEquals(len(stats), 4)
+        for (zone, instance_type), values in stats.items():
+            prices = [p for _, i, p in histories[zone] if i == instance_type]
+            self.assertEquals(values['recent'], prices[-1])
+            self.assertEquals(values['median'], util.median(prices))
+            self.assertAlmostEqual(values['stddev'], util.stddev(prices))
+            self.assertEquals(values['max'], max(prices))
+        self.assertEquals(ec2.spot_price_stats({'fake-1a': []}), {})
+
+    def test_pricing_zones(self):
+        self.fake_ec2([], regions=['fake-1'], spot_prices=make_spot_prices(
+            ['fake-1a', 'fake-1b'], ['m1.small'], 0, 2 * 24 * 60 * 60))
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            ec2.pricing(zones='fake-1a;fake-1b')
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEquals(output.split('\n')[0].split()[:2], ['size', 'zone'])
+        self.assertEquals(len(output.strip().split('\n')), 5)
+        self.assertEquals(len(self.spot_calls()), 2)
+
+class TestCheapestSpot(EC2TestCase):
+
+    # current spot prices, and the bid is 0.05
+    PRICES = {
+        ('c3.large', 'fake-1b'): 0.02,
+        ('m1.small', 'fake-1a'): 0.03,
+        ('c3.large', 'fake-1a'): 0.04,
+        ('m1.small', 'fake-1b'): 0.06,
+    }
+
+    def setUp(self):
+        super(TestCheapestSpot, self).setUp()
+        self.original_time = ec2.time
+        ec2.time = self.fake_time = FakeTime()
+        self.fake_time.now = 24 * 60 * 60
+        self.original_reachable = util.reachable
+        util.reachable = lambda hosts, port: set(hosts)
+        self.original_get_node_types = ec2.get_node_types
+        ec2.get_node_types = lambda: {'m1.small': {'linux_cost': 0.044},
+                                      'c3.large': {'linux_cost': 0.105}}
+        self.original_deadline = ec2.SPOT_DEADLINE
+
+    def tearDown(self):
+        ec2.time = self.original_time
+        util.reachable = self.original_reachable
+        ec2.get_node_types = self.original_get_node_types
+        ec2.SPOT_DEADLINE = self.original_deadline
+        super(TestCheapestSpot, self).tearDown()
+
+    def create(self, count, spot_delays):
+        prices = [{'zone': zone, 'type': size, 'price': price,
+                   'timestamp': ec2._timestamp(self.fake_time.now - 60)}
+                  for (size, zone), price in self.PRICES.items()]
+        self.fake_ec2([], regions=['fake-1'], clock=self.fake_time.time,
+                      spot_prices=prices, spot_delays=spot_delays)
+        return ec2.create_servers(count, ['web'] * count, size='m1.small;c3.large',
+                                  placement='fake-1a;fake-1b', bid='0.05',
+                                  image='ubuntu 14.04', security_group='default')
+
+    def requested(self):
+        return sorted(set((r['size'], r['zone']) for r in self.fake.spot_requests))
+
+    def test_keeps_cheapest(self):
+        nodes = self.create(10, {('c3.large', 'fake-1b'): 30,
+                                 ('m1.small', 'fake-1a'): 30,
+                                 ('c3.large', 'fake-1a'): 10})
+        self.assertEquals(len(nodes), 10)
+        self.assertEquals(set(n['name'] for n in nodes), set(['web']))
+        self.assertEquals(self.requested(), [('c3.large', 'fake-1a'), ('c3.large', 'fake-1b'),
+                                             ('m1.small', 'fake-1a')])
+        self.assertEquals(self.fake.calls('RequestSpotInstances'), 3)
+
+        # the first ten to be fulfilled are kept, the others cancelled
+        states = [(r['size'], r['zone'], r['state']) for r in self.fake.spot_requests]
+        self.assertEquals(states.count(('c3.large', 'fake-1a', 'active')), 10)
+        self.assertEquals(len([s for s in states if s[2] == 'cancelled']), 20)
+        self.assertEquals(self.fake.calls('RunInstances'), 0)
+        self.assertEquals(self.fake.calls('TerminateInstances'), 0)
+
+    def test_terminates_surplus(self):
+        nodes = self.create(10, {('c3.large', 'fake-1b'): 10,
+                                 ('m1.small', 'fake-1a'): 10})
+        kept = set(n['id'] for n in nodes)
+        cheapest = set(r['instance_id'] for r in self.fake.spot_requests
+                       if (r['size'], r['zone']) == ('c3.large', 'fake-1b'))
+        self.assertEquals(kept, cheapest)
+        self.assertEquals(self.fake.calls('TerminateInstances'), 1)
+        terminated = [x for x in self.fake.instances if x['state'] == 'shutting-down']
+        self.assertEquals(len(terminated), 10)
+        self.assertFalse(kept & set('i-' + x['id'] for x in terminated))
+
+    def test_on_demand_fallback(self):
+        ec2.SPOT_DEADLINE = 60
+        start = self.fake_time.now
+        nodes = self.create(10, {})
+        self.assertEquals(len(nodes), 10)
+        self.assertEquals(self.fake.calls('RunInstances'), 1)
+        self.assertEquals(set(r['state'] for r in self.fake.spot_requests), set(['cancelled']))
+        self.assertEquals([p['InstanceType'] for p, _ in self.fake.requests
+                           if p['Action'] == 'RunInstances'], ['m1.small'])
+        self.assertLess(self.fake_time.now - start, 60 + 60)
+
+    def test_validate(self):
+        options = dict(image='ami-1e917676', security_group='default')
+        ec2.validate_create_options(size='m1.small;c3.large', placement='fake-1a;fake-1b',
+                                    bid='0.05', **options)
+        self.assertRaises(Exception, ec2.validate_create_options, size='m1.small;c3.large',
+                          placement='fake-1a', bid='', **options)
+        ec2.get_node_types.downloaded = True
+        self.assertRaises(Exception, ec2.validate_create_options, size='m1.small;m3.huge',
+                          placement='fake-1a', bid='0.05', **options)
+
+    def test_validate_image_alias(self):
+        options = dict(size='m1.small', bid='', security_group='default')
+        self.assertEquals(ec2.validate_create_options(
+            image='ubuntu 14.04', placement='us-east-1b', **options)['image'], 'ami-1e917676')
+        self.assertRaises(Exception, ec2.validate_create_options,
+                          image='ubuntu 14.04', placement='eu-west-1a', **options)
+        self.assertEquals(ec2.validate_create_options(
+            image='ami-12345678', placement='eu-west-1a', **options)['image'], 'ami-12345678')
+
+    def test_equivalent_create_options(self):
+        options = dict(size='m1.small;c3.large', placement='fake-1a;fake-1b',
+                       image='ubuntu 14.04', security_group='default')
+        node = dict(options, size='c3.large', placement='fake-1b', image='ami-1e917676')
+        self.assertTrue(ec2.equivalent_create_options(options, node))
+        self.assertTrue(ec2.equivalent_create_options(node, options))
+        self.assertFalse(ec2.equivalent_create_options(options, dict(node, size='m3.medium')))
+        self.assertFalse(ec2.equivalent_create_options(options, dict(node, placement='fake-1c')))
+
+class TestNodeTypes(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.original = (ec2.NODE_TYPES_URL, ec2.NODE_TYPES_FILENAME)
+        ec2.NODE_TYPES_FILENAME = os.path.join(self.directory, 'ec2_node_types.json')
+        self.pricing = FakePricing()
+        ec2.NODE_TYPES_URL = self.pricing.url()
+
+    def tearDown(self):
+        ec2.NODE_TYPES_URL, ec2.NODE_TYPES_FILENAME = self.original
+        if hasattr(ec2.get_node_types, 'node_types'):
+            del ec2.get_node_types.node_types
+        self.pricing.close()
+        shutil.rmtree(self.directory)
+
+    def node_types(self):
+        # as in a new process
+        if hasattr(ec2.get_node_types, 'node_types'):
+            del ec2.get_node_types.node_types
+        return ec2.get_node_types()
+
+    def test_refresh(self):
+        self.assertEquals(self.node_types()['m3.medium']['linux_cost'], 0.07)
+        self.assertEquals(self.node_types()['g2.2xlarge']['gpu'], 'gpu')
+        self.assertEquals(len(self.pricing.requests), 1)
+
+        # unchanged after the ttl
+        old = os.path.getmtime(ec2.NODE_TYPES_FILENAME) - ec2.NODE_TYPES_TTL - 1
+        os.utime(ec2.NODE_TYPES_FILENAME, (old, old))
+        self.assertEquals(self.node_types()['m3.medium']['linux_cost'], 0.07)
+        self.assertEquals(self.pricing.requests[-1]['if-none-match'], '"0.070"')
+        self.assertGreater(os.path.getmtime(ec2.NODE_TYPES_FILENAME), old)
+
+        # changed after the ttl
+        self.pricing.price = '0.080'
+        os.utime(ec2.NODE_TYPES_FILENAME, (old, old))
+        self.assertEquals(self.node_types()['m3.medium']['linux_cost'], 0.08)
+        self.assertEquals(len(self.pricing.requests), 3)
+
+    def test_offline(self):
+        ec2.NODE_TYPES_URL = 'http://127.0.0.1:1/linux-od.js'
+        node_types = self.node_types()
+        self.assertIn('m1.small', node_types)
+        self.assertEquals(node_types['m1.small']['memory'], 1.7)
+        self.assertEquals(node_types['m1.small']['linux_cost'], 0.044)
+        self.assertEquals(ec2._on_demand_fallback(['c3.large', 'm1.small'], ['us-east-1a'], []),
+                          ('m1.small', 'us-east-1a'))
+
+        # the snapshot is kept, so other processes don't retry until the ttl
+        self.assertTrue(os.path.exists(ec2.NODE_TYPES_FILENAME))
+        ec2.NODE_TYPES_URL = self.pricing.url()
+        self.assertEquals(self.node_types()['m1.small']['linux_cost'], 0.044)
+        self.assertEquals(self.pricing.requests, [])
+
+        # the snapshot doesn't know newer sizes
+        options = dict(placement=None, bid=None, image='ubuntu 14.04', security_group=None)
+        ec2.validate_create_options(size='m5.large', **options)
+
+    def test_validate_size(self):
+        self.node_types()
+        options = dict(placement=None, bid=None, image='ubuntu 14.04', security_group=None)
+        self.assertEquals(ec2.validate_create_options(size='m3.medium', **options)['image'],
+                          'ami-1e917676')
+        self.assertRaises(Exception, ec2.validate_create_options, size='m3.huge', **options)
+        self.assertEquals(len(self.pricing.requests), 1)
+
+class TestReachable(unittest.TestCase):
+
+    def test_reachable(self):
+        listeners = []
+        for _ in range(3):
+            listener = socket.socket()
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(5)
+            listeners.append(listener)
+        port = listeners[0].getsockname()[1]
+
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        closed_port = closed.getsockname()[1]
+        closed.close()
+
+        try:
+            self.assertEquals(util.reachable(['127.0.0.1', '127.0.0.2'], port, timeout=2),
+                              set(['127.0.0.1']))
+            self.assertEquals(util.reachable(['127.0.0.1'], closed_port, timeout=2), set())
+            self.assertEquals(util.reachable([], port), set())
+        finally:
+            for listener in listeners:
+                listener.close()
@@ -1,9 +1,13 @@
 import time
+import types
 import unittest2 as unittest
 import yaml
 import simplejson as json
 import mox
 
+from fabric.api import env
+
+import headintheclouds
 from headintheclouds import docker
 from headintheclouds import ec2
 
@@ -428,6 +432,45 @@ class TestMultiprocess(unittest.TestCase):
 
         create.create_things(servers, graph, set(), set(), set())
 
+    def test_batch_servers(self):
+        provider = FakeProvider('fake')
+        env.providers['fake'] = provider
+        original_multi_threaded = create.MULTI_THREADED
+        create.MULTI_THREADED = False
+        try:
+            servers = {name: Server(name, provider='fake', size=size)
+                       for name, size in [('web', 'small'), ('web-1', 'small'),
+                                          ('web-2', 'small'), ('db', 'large')]}
+            thing_index = create.create_things(servers, DependencyGraph(), set(), set(), set())
+        finally:
+            create.MULTI_THREADED = original_multi_threaded
+            del env.providers['fake']
+
+        self.assertEquals(sorted(provider.calls), [
+            (1, ['db'], 'large', None),
+            (3, ['web', 'web-1', 'web-2'], 'small', None),
+        ])
+        self.assertEquals(thing_index[('SERVER', 'web-2')].fields['ip'], '10.0.0.3')
+        self.assertTrue(thing_index[('SERVER', 'db')].fields['running'])
+
+    def test_batch_servers_spot(self):
+        provider = FakeProvider('fake')
+        env.providers['fake'] = provider
+        original_multi_threaded = create.MULTI_THREADED
+        create.MULTI_THREADED = False
+        try:
+            servers = {'spot': Server('spot', provider='fake', size='small', bid='0.05'),
+                       'on-demand': Server('on-demand', provider='fake', size='small')}
+            create.create_things(servers, DependencyGraph(), set(), set(), set())
+        finally:
+            create.MULTI_THREADED = original_multi_threaded
+            del env.providers['fake']
+
+        self.assertEquals(sorted(provider.calls), [
+            (1, ['on-demand'], 'small', None),
+            (1, ['spot'], 'small', '0.05'),
+        ])
+
     def test_multiple_dependencies(self):
         pass
 
@@ -443,6 +486,22 @@ class DummyServer(Server):
     def is_active(self):
         return True
 
+class FakeProvider(types.ModuleType):
+
+    create_server_defaults = {'size': None, 'bid': None}
+
+    def __init__(self, name):
+        super(FakeProvider, self).__init__(name)
+        self.calls = []
+
+    def create_servers(self, count, names, size, bid):
+        self.calls.append((count, names, size, bid))
+        return [{'name': name, 'ip': '10.0.0.%d' % i, 'running': True}
+                for i, name in reversed(list(enumerate(names, 1)))]
+
+    def equivalent_create_options(self, options1, options2):
+        return options1['size'] == options2['size']
+
 class DummyContainer(Container):
 
     def create(self):
@@ -0,0 +1,308 @@
+import time
+import types
+import subprocess
+import unittest2 as unittest
+
+from fabric.api import env, execute
+from fabric.tasks import WrappedCallableTask
+
+import headintheclouds
+from headintheclouds import tasks, cache, util
+
+class FakeProvider(types.ModuleType):
+
+    def __init__(self, name, nodes, latency=0):
+        super(FakeProvider, self).__init__(name)
+        self.nodes = nodes
+        self.latency = latency
+        self.calls = 0
+
+    def all_nodes(self):
+        self.calls += 1
+        time.sleep(self.latency)
+        if isinstance(self.nodes, BaseException):
+            raise self.nodes
+        return [dict(node) for node in self.nodes]
+
+class TestLazyDiscovery(unittest.TestCase):
+
+    def setUp(self):
+        self.original_env = {k: env[k] for k in ('providers', 'roledefs', 'hosts', 'node_providers')}
+        env.providers = {}
+        env.roledefs = headintheclouds._LazyRoledefs()
+        env.hosts = headintheclouds._LazyHosts()
+        env.node_providers = {}
+        headintheclouds._discovered_providers.clear()
+
+        self.provider = FakeProvider('fake', [
+            {'name': 'web', 'ip': '10.0.0.1'},
+            {'name': 'web-1', 'ip': '10.0.0.2'},
+            {'name': 'db', 'ip': '10.0.0.3'},
+            {'name': 'pending', 'ip': None},
+        ], latency=1)
+
+    def tearDown(self):
+        env.update(self.original_env)
+        headintheclouds._discovered_providers.clear()
+
+    def test_add_provider_makes_no_calls(self):
+        start = time.time()
+        headintheclouds.add_provider('fake', self.provider)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEquals(self.provider.calls, 0)
+
+    def test_roledefs(self):
+        headintheclouds.add_provider('fake', self.provider)
+        self.assertIn('web', env.roledefs)
+        self.assertEquals(env.roledefs['web'], ['10.0.0.1', '10.0.0.2'])
+        self.assertEquals(sorted(env.roledefs.keys()), ['db', 'web'])
+        self.assertEquals(self.provider.calls, 1)
+
+    def test_hosts(self):
+        headintheclouds.add_provider('fake', self.provider)
+        self.assertEquals(list(env.hosts), ['10.0.0.1', '10.0.0.2', '10.0.0.3'])
+        self.assertEquals(len(env.hosts), 3)
+        self.assertEquals(self.provider.calls, 1)
+
+    def test_this_provider(self):
+        headintheclouds.add_provider('fake', self.provider)
+        env.host = '10.0.0.3'
+        try:
+            self.assertIs(headintheclouds.this_provider(), self.provider)
+        finally:
+            env.host = None
+
+    def test_all_nodes_copies_nodes(self):
+        nodes = [{'name': 'web', 'ip': '10.0.0.1'}]
+        shared = types.ModuleType('shared')
+        shared.all_nodes = lambda: nodes
+        headintheclouds.add_provider('shared', shared)
+        self.assertEquals(headintheclouds.all_nodes(),
+                          [{'name': 'web', 'ip': '10.0.0.1', 'provider': 'shared'}])
+        self.assertEquals(nodes, [{'name': 'web', 'ip': '10.0.0.1'}])
+
+    def test_provider_added_after_discovery(self):
+        headintheclouds.add_provider('fake', self.provider)
+        list(env.hosts)
+        other = FakeProvider('other', [{'name': 'cache', 'ip': '10.0.1.1'}])
+        headintheclouds.add_provider('other', other)
+        self.assertEquals(other.calls, 1)
+        self.assertEquals(env.roledefs['cache'], ['10.0.1.1'])
+        self.assertEquals(self.provider.calls, 1)
+
+    def test_hostless_task(self):
+        headintheclouds.add_provider('fake', self.provider)
+        self.assertEquals(tasks.nodes.get_hosts_and_effective_roles([], [], [], env), ([], []))
+        self.assertEquals(self.provider.calls, 0)
+
+        hosts, roles = tasks.nodes.get_hosts_and_effective_roles([], ['db'], [], env)
+        self.assertEquals(hosts, ['10.0.0.3'])
+        self.assertEquals(self.provider.calls, 1)
+
+        hosts, roles = WrappedCallableTask(lambda: None).get_hosts_and_effective_roles([], [], [], env)
+        self.assertEquals(hosts, ['10.0.0.1', '10.0.0.2', '10.0.0.3'])
+
+class TestConcurrentDiscovery(unittest.TestCase):
+
+    def setUp(self):
+        self.original_env = {k: env[k] for k in ('providers', 'roledefs', 'hosts', 'node_providers')}
+        env.providers = {}
+        env.roledefs = headintheclouds._LazyRoledefs()
+        env.hosts = headintheclouds._LazyHosts()
+        env.node_providers = {}
+        headintheclouds._discovered_providers.clear()
+
+    def tearDown(self):
+        env.update(self.original_env)
+        headintheclouds._discovered_providers.clear()
+
+    def add(self, name, nodes, latency=0):
+        provider = FakeProvider(name, nodes, latency)
+        headintheclouds.add_provider(name, provider)
+        return provider
+
+    def test_concurrent(self):
+        for i in range(5):
+            self.add('fake%d' % i, [{'name': 'node%d' % i, 'ip': '10.0.0.%d' % i}], latency=0.3)
+        start = time.time()
+        nodes = headintheclouds.all_nodes()
+        self.assertLess(time.time() - start, 0.9)
+        self.assertEquals(sorted((n['provider'], n['ip']) for n in nodes),
+                          [('fake%d' % i, '10.0.0.%d' % i) for i in range(5)])
+
+    def test_discovery_ignores_errors(self):
+        self.add('good', [{'name': 'web', 'ip': '10.0.0.1'}])
+        self.add('bad', ValueError('no credentials'))
+        self.assertEquals(env.roledefs['web'], ['10.0.0.1'])
+        self.assertEquals(list(env.hosts), ['10.0.0.1'])
+
+    def test_all_nodes_raises(self):
+        self.add('good', [{'name': 'web', 'ip': '10.0.0.1'}])
+        self.add('bad', ValueError('no credentials'))
+        self.assertRaises(ValueError, headintheclouds.all_nodes)
+        self.assertEquals([n['ip'] for n in headintheclouds.all_nodes(ignore_errors=True)],
+                          ['10.0.0.1'])
+
+    def test_abort(self):
+        # fabric's abort() raises SystemExit
+        self.add('good', [{'name': 'web', 'ip': '10.0.0.1'}])
+        self.add('boot2docker', SystemExit(1))
+        self.assertEquals(list(env.hosts), ['10.0.0.1'])
+        self.assertRaises(SystemExit, headintheclouds.all_nodes)
+
+    def test_parallel_map_abort(self):
+        def func(x):
+            if x == 2:
+                raise SystemExit(1)
+            return x
+        self.assertEquals(util.parallel_map(func, [1, 3]), [1, 3])
+        self.assertRaises(SystemExit, util.parallel_map, func, [1, 2, 3])
+
+    def test_timeout(self):
+        self.add('fast', [{'name': 'web', 'ip': '10.0.0.1'}])
+        self.add('slow', [{'name': 'db', 'ip': '10.0.0.2'}], latency=2)
+        start = time.time()
+        nodes = headintheclouds.provider_nodes(env.providers, ignore_errors=True, timeout=0.2)
+        self.assertLess(time.time() - start, 1)
+        self.assertEquals(nodes.keys(), ['fast'])
+        self.assertRaises(Exception, headintheclouds.provider_nodes,
+                          env.providers, timeout=0.2)
+
+class TestBoot2docker(unittest.TestCase):
+
+    def setUp(self):
+        self.original_providers = env.providers.copy()
+        self.original_filename = cache.FILENAME
+        cache.FILENAME = 'tmp_test_cache.db'
+
+        self.popen_calls = 0
+        original_popen = subprocess.Popen
+        def popen(*args, **kwargs):
+            self.popen_calls += 1
+            raise OSError('boot2docker not installed')
+        subprocess.Popen = popen
+        try:
+            from headintheclouds import boot2docker
+            self.boot2docker = reload(boot2docker)
+        finally:
+            subprocess.Popen = original_popen
+
+        self.commands = []
+        def local(command, capture=False):
+            self.commands.append(command)
+            if command == 'boot2docker ip':
+                return '192.168.59.103'
+            return 'SSHKey = "/home/user/.ssh/id_boot2docker"'
+        self.boot2docker.local = local
+
+    def tearDown(self):
+        env.providers = self.original_providers
+        cache.flush()
+        cache.FILENAME = self.original_filename
+
+    def test_import_runs_nothing(self):
+        self.assertEquals(self.popen_calls, 0)
+
+    def test_looked_up_once(self):
+        for _ in range(3):
+            self.assertEquals(self.boot2docker.all_nodes()[0]['ip'], '192.168.59.103')
+            settings = dict(self.boot2docker.settings)
+        self.assertEquals(settings['port'], 22)
+        self.assertEquals(settings['user'], 'docker')
+        self.assertEquals(sorted(self.commands), [
+            "boot2docker config | awk '/SSHKey/ { print $3 }'",
+            'boot2docker ip',
+        ])
+
+    def test_persist(self):
+        self.boot2docker.PERSIST_VM_CONFIG = True
+        self.boot2docker.get_boot2docker_ip()
+        del self.boot2docker.get_boot2docker_ip.value
+        self.assertEquals(self.boot2docker.get_boot2docker_ip(), '192.168.59.103')
+        self.assertEquals(self.commands, ['boot2docker ip'])
+
+class TestNodeIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.original_filename = cache.FILENAME
+        cache.FILENAME = 'tmp_test_cache.db'
+        self.original_host = env.host
+        self.original_providers = env.providers
+        self.original_node_providers = env.node_providers
+
+        self.listed = 0
+        @cache.cached(ttl=60)
+        def all_nodes():
+            self.listed += 1
+            return [{'id': 'i-%d' % i, 'name': 'node-%d' % i, 'ip': '10.0.%d.%d' % (i / 256, i % 256)}
+                    for i in range(1000)]
+        self.all_nodes = all_nodes
+
+    def tearDown(self):
+        cache.flush()
+        cache.FILENAME = self.original_filename
+        env.host = self.original_host
+        env.providers = self.original_providers
+        env.node_providers = self.original_node_providers
+        headintheclouds._node_indexes.clear()
+
+    def test_host_node(self):
+        for i in range(1000):
+            env.host = '10.0.%d.%d' % (i / 256, i % 256)
+            self.assertEquals(headintheclouds.host_node(self.all_nodes)['id'], 'i-%d' % i)
+        self.assertEquals(self.listed, 1)
+        self.assertEquals(headintheclouds.node_index(self.all_nodes).by_id['i-5']['name'], 'node-5')
+
+        env.host = '192.168.0.1'
+        self.assertRaises(Exception, headintheclouds.host_node, self.all_nodes)
+
+    def test_rebuilt_on_refresh(self):
+        index = headintheclouds.node_index(self.all_nodes)
+        self.assertIs(headintheclouds.node_index(self.all_nodes), index)
+        cache.recache(self.all_nodes)
+        self.assertIsNot(headintheclouds.node_index(self.all_nodes), index)
+        self.assertEquals(self.listed, 2)
+
+    def test_this_provider(self):
+        provider = types.ModuleType('fake')
+        provider.all_nodes = self.all_nodes
+        env.providers = {'fake': provider}
+        env.node_providers = {}
+        headintheclouds._discovered_providers.add('fake')
+        try:
+            env.host = '10.0.1.0'
+            self.assertIs(headintheclouds.this_provider(), provider)
+        finally:
+            headintheclouds._discovered_providers.discard('fake')
+
+class TestBatchTasks(unittest.TestCase):
+
+    def setUp(self):
+        self.original_env = {k: env[k] for k in ('providers', 'roledefs', 'hosts', 'node_providers')}
+        env.providers = {}
+        env.roledefs = headintheclouds._LazyRoledefs()
+        env.hosts = headintheclouds._LazyHosts()
+        env.node_providers = {}
+        headintheclouds._discovered_providers.clear()
+
+    def tearDown(self):
+        env.update(self.original_env)
+        headintheclouds._discovered_providers.clear()
+        headintheclouds._node_indexes.clear()
+
+    def test_terminate_batch(self):
+        batched = FakeProvider('batched', [{'name': 'web-%d' % i, 'ip': '10.0.0.%d' % i}
+                                           for i in range(200)])
+        batched.terminated = []
+        batched.terminate_nodes = batched.terminated.append
+        single = FakeProvider('single', [{'name': 'db', 'ip': '10.0.1.1'}])
+        single.terminated = []
+        single.terminate = lambda: single.terminated.append(env.host)
+        headintheclouds.add_provider('batched', batched)
+        headintheclouds.add_provider('single', single)
+
+        hosts = ['10.0.0.%d' % i for i in range(200)] + ['10.0.1.1']
+        execute(tasks.terminate_batch, immediately=True, hosts=hosts)
+        self.assertEquals(len(batched.terminated), 1)
+        self.assertEquals([n['ip'] for n in batched.terminated[0]], hosts[:200])
+        self.assertEquals(single.terminated, ['10.0.1.1'])
@@ -0,0 +1,198 @@
+import os
+import unittest2 as unittest
+
+from headintheclouds.dependencies.PyDbLite import PyDbLite
+
+FILENAME = 'tmp_test_pydblite.pdl'
+
+class TestLazy(unittest.TestCase):
+
+    def setUp(self):
+        db = PyDbLite.Base(FILENAME, lazy=True)
+        db.create('key', 'value')
+        db.create_index('key')
+        for i in range(10):
+            db.insert(key=i, value='value-%d' % i)
+        db.commit()
+
+    def tearDown(self):
+        os.unlink(FILENAME)
+
+    def test_open_loads_records_on_demand(self):
+        db = PyDbLite.Base(FILENAME, lazy=True).open()
+        self.assertEquals(len(db), 10)
+        self.assertEquals(db.records.loaded, {})
+
+        self.assertEquals(db._key[3][0]['value'], 'value-3')
+        self.assertEquals(db.records.loaded.keys(), [3])
+        self.assertEquals(len(db), 10)
+
+    def test_commit(self):
+        db = PyDbLite.Base(FILENAME, lazy=True).open()
+        db.update(db._key[3], value='updated')
+        db.delete(db._key[4])
+        db.insert(key=10, value='value-10')
+        db.commit()
+
+        db = PyDbLite.Base(FILENAME, lazy=True).open()
+        self.assertEquals(len(db), 10)
+        self.assertEquals(db._key[3][0]['value'], 'updated')
+        self.assertEquals(db._key[4], [])
+        self.assertEquals(db._key[10][0]['value'], 'value-10')
+        self.assertEquals(sorted(r['key'] for r in db), [0, 1, 2, 3, 5, 6, 7, 8, 9, 10])
+
+    def test_open_lazy_file_eagerly(self):
+        db = PyDbLite.Base(FILENAME).open()
+        self.assertIsInstance(db.records, dict)
+        self.assertEquals(db._key[3][0]['value'], 'value-3')
+
+        # committing a non-lazy base goes back to the classic layout
+        db.commit()
+        db = PyDbLite.Base(FILENAME, lazy=True).open()
+        self.assertIsInstance(db.records, dict)
+        self.assertEquals(len(db), 10)
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        db = PyDbLite.Base(FILENAME, journal=True)
+        db.create('key', 'value')
+        db.create_index('key')
+        for i in range(10):
+            db.insert(key=i, value='value-%d' % i)
+        db.commit()
+
+    def tearDown(self):
+        for filename in (FILENAME, FILENAME + '.journal'):
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+    def test_commit_appends_to_journal(self):
+        base_size = os.path.getsize(FILENAME)
+
+        db = PyDbLite.Base(FILENAME, journal=True).open()
+        db.update(db._key[3], value='updated')
+        db.delete(db._key[4])
+        db.insert(key=10, value='value-10')
+        db.commit()
+
+        self.assertEquals(os.path.getsize(FILENAME), base_size)
+
+        db = PyDbLite.Base(FILENAME, journal=True).open()
+        self.assertEquals(len(db), 10)
+        self.assertEquals(db._key[3][0]['value'], 'updated')
+        self.assertEquals(db._key[3][0]['__version__'], 1)
+        self.assertEquals(db._key[4], [])
+        self.assertEquals(db._key[10][0]['value'], 'value-10')
+        self.assertEquals(db.next_id, 11)
+
+    def test_checkpoint(self):
+        db = PyDbLite.Base(FILENAME, journal=True, journal_size=1000).open()
+        for i in range(100):
+            db.update(db._key[1], value='value-%d' % i)
+            db.commit()
+            if os.path.exists(db.journal_name):
+                self.assertLess(os.path.getsize(db.journal_name), 1000)
+
+        db = PyDbLite.Base(FILENAME).open()
+        self.assertEquals(db._key[1][0]['value'], 'value-99')
+
+    def test_truncated_journal(self):
+        db = PyDbLite.Base(FILENAME, journal=True).open()
+        db.update(db._key[1], value='updated')
+        db.commit()
+        size = os.path.getsize(db.journal_name)
+        db.update(db._key[2], value='updated')
+        db.commit()
+
+        with open(db.journal_name, 'r+b') as f:
+            f.truncate(os.path.getsize(db.journal_name) - 5)
+
+        db = PyDbLite.Base(FILENAME, journal=True).open()
+        self.assertEquals(db._key[1][0]['value'], 'updated')
+        self.assertEquals(db._key[2][0]['value'], 'value-2')
+        self.assertEquals(os.path.getsize(db.journal_name), size)
+
+    def test_crash_in_checkpoint(self):
+        db = PyDbLite.Base(FILENAME, journal=True).open()
+        db.update(db._key[3], value='updated')
+        db.commit()
+        db.delete(db._key[3])
+
+        # crash after the new base replaces the old one, before the
+        # journal is removed
+        def crash(filename):
+            raise KeyboardInterrupt
+        original_remove = os.remove
+        os.remove = crash
+        try:
+            self.assertRaises(KeyboardInterrupt, db.create_index, 'value')
+        finally:
+            os.remove = original_remove
+
+        db = PyDbLite.Base(FILENAME, journal=True).open()
+        self.assertEquals(db._key[3], [])
+        self.assertEquals(len(db), 9)
+
+    def test_lazy(self):
+        db = PyDbLite.Base(FILENAME, lazy=True, journal=True).open()
+        db.checkpoint()
+        db.update(db._key[3], value='updated')
+        db.commit()
+
+        db = PyDbLite.Base(FILENAME, lazy=True, journal=True).open()
+        self.assertEquals(sorted(db.records.loaded.keys()), [3])
+        self.assertEquals(db._key[3][0]['value'], 'updated')
+        self.assertEquals(db._key[5][0]['value'], 'value-5')
+
+class TestHashIndex(unittest.TestCase):
+
+    def tearDown(self):
+        for filename in (FILENAME, FILENAME + '.journal'):
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+    def create(self, **kwargs):
+        db = PyDbLite.Base(FILENAME, **kwargs)
+        db.create('key', 'state')
+        db.create_index('key', kind='hash')
+        db.create_index('state')
+        for i in range(10):
+            db.insert(key=i, state='running' if i % 2 else 'pending')
+        return db
+
+    def test_lookup(self):
+        db = self.create()
+        self.assertIsInstance(db.indices['key'], PyDbLite.HashIndex)
+        self.assertNotIsInstance(db.indices['state'], PyDbLite.HashIndex)
+        self.assertEquals(db._key[3][0]['state'], 'running')
+        self.assertEquals(len(db(key=3, state='running')), 1)
+        self.assertEquals(db(key=3, state='pending'), [])
+
+    def test_update_delete(self):
+        db = self.create()
+        db.update(db._key[3], key=30)
+        db.delete(db._key[4])
+        self.assertEquals(db._key[3], [])
+        self.assertEquals(db._key[30][0]['__id__'], 3)
+        self.assertEquals(db._key[4], [])
+        self.assertEquals(sorted(db.indices['key'].keys()),
+                          [0, 1, 2, 5, 6, 7, 8, 9, 30])
+
+    def test_persist(self):
+        for kwargs in ({}, {'lazy': True}, {'journal': True}):
+            db = self.create(**kwargs)
+            db.commit()
+            db.delete(db._key[5])
+            db.commit()
+
+            db = PyDbLite.Base(FILENAME, **kwargs).open()
+            self.assertIsInstance(db.indices['key'], PyDbLite.HashIndex)
+            self.assertEquals(db._key[5], [])
+            self.assertEquals(db._key[6][0]['state'], 'pending')
+            self.tearDown()
+
+    def test_unknown_kind(self):
+        db = PyDbLite.Base(FILENAME)
+        db.create('key')
+        self.assertRaises(ValueError, db.create_index, 'key', kind='btree')